@@ -0,0 +1,111 @@
+"""
+Estimación de costo y orden de procesamiento de los archivos de un lote
+"""
+import os
+import logging
+import threading
+
+from PIL import Image
+
+from pdf_render import get_page_sizes
+from image_decode import is_heif, is_path, open_source
+
+logger = logging.getLogger(__name__)
+
+def prescan_file(file_path, file_type, pdf_dpi=300):
+    """
+    Estima el trabajo de un archivo sin decodificarlo
+    
+    Lee solo la estructura del PDF (número y tamaño de páginas) o la cabecera
+    de la imagen (dimensiones). Si no puede leerse, estima por tamaño en disco.
+    
+    Args:
+        file_path: Ruta al archivo o su contenido (bytes)
+        file_type: Tipo MIME del archivo
+        pdf_dpi: Resolución a la que se rasterizan las páginas del PDF
+    
+    Returns:
+        dict con 'pages', 'megapixels' (a procesar en el peor caso) y 'source'
+        ('pdf', 'header' o 'file_size')
+    """
+    try:
+        if file_type == 'application/pdf' or (is_path(file_path) and file_path.lower().endswith('.pdf')):
+            sizes = get_page_sizes(file_path)
+            megapixels = sum(width * height for width, height in sizes) * (pdf_dpi / 72) ** 2 / 1e6
+            return {'pages': len(sizes), 'megapixels': round(megapixels, 2), 'source': 'pdf'}
+        
+        if is_heif(file_path, file_type):
+            from pillow_heif import open_heif
+            heif = open_heif(open_source(file_path))
+            pages = len(heif)
+            width, height = heif.size
+        else:
+            # Image.open solo lee la cabecera; los píxeles no se decodifican
+            with Image.open(open_source(file_path)) as image:
+                width, height = image.size
+                pages = getattr(image, 'n_frames', 1)
+        return {'pages': pages, 'megapixels': round(width * height * pages / 1e6, 2), 'source': 'header'}
+    except Exception as e:
+        logger.debug(f"No se pudo pre-escanear {file_path if is_path(file_path) else 'el archivo'}: {e}")
+    
+    # Respaldo: un megapíxel por cada 300 KB comprimidos
+    try:
+        size = os.path.getsize(file_path) if is_path(file_path) else len(file_path)
+    except OSError:
+        size = 0
+    return {'pages': 1, 'megapixels': round(max(size / 300000, 1.0), 2), 'source': 'file_size'}
+
+class BatchPlanner:
+    """
+    Modelo de costo (segundos por megapíxel) calibrado con los archivos ya procesados
+    
+    Ordena el lote de menor a mayor costo para que un archivo grande no
+    bloquee a los pequeños encolados detrás y estima el tiempo restante.
+    """
+    
+    def __init__(self, seconds_per_megapixel=0.1, overhead_seconds=0.05, smoothing=0.2):
+        """
+        Args:
+            seconds_per_megapixel: Costo inicial antes de calibrar
+            overhead_seconds: Costo fijo por archivo
+            smoothing: Peso de cada observación en la media móvil exponencial
+        """
+        self.seconds_per_megapixel = seconds_per_megapixel
+        self.overhead_seconds = overhead_seconds
+        self.smoothing = smoothing
+        self.observations = 0
+        self._lock = threading.Lock()
+    
+    def estimate_seconds(self, estimate):
+        """Tiempo esperado para un archivo pre-escaneado"""
+        return self.overhead_seconds + estimate['megapixels'] * self.seconds_per_megapixel
+    
+    def order(self, entries):
+        """
+        Ordena las entradas de un lote por costo estimado (las más baratas primero)
+        
+        Args:
+            entries: Lista de dicts con la clave 'estimate' (resultado de prescan_file)
+        """
+        return sorted(entries, key=lambda entry: entry['estimate']['megapixels'])
+    
+    def remaining_seconds(self, entries):
+        """Tiempo esperado para procesar todas las entradas"""
+        return sum(self.estimate_seconds(entry['estimate']) for entry in entries)
+    
+    def observe(self, estimate, seconds):
+        """Calibra el modelo con el tiempo real de un archivo"""
+        megapixels = estimate['megapixels']
+        if megapixels <= 0:
+            return
+        observed = max(seconds - self.overhead_seconds, 0) / megapixels
+        with self._lock:
+            self.seconds_per_megapixel += self.smoothing * (observed - self.seconds_per_megapixel)
+            self.observations += 1
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'seconds_per_megapixel': round(self.seconds_per_megapixel, 4),
+                'observations': self.observations
+            }
@@ -14,6 +14,20 @@ class Config:
     # Configuración de archivos
     UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'uploads')
     MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 1024 * 1024 * 1024))  # 1GB por defecto
+    # Archivos por petición (en /api/process-qr los siguientes no se leen ni se procesan)
+    MAX_FILES = int(os.getenv('MAX_FILES', '500'))
+    # Procesar cada archivo en cuanto termina de subir (False = recibir el lote completo primero)
+    QR_STREAMING_UPLOADS = os.getenv('QR_STREAMING_UPLOADS', 'True').lower() == 'true'
+    # Archivos hasta este tamaño se decodifican desde memoria, sin escribirse en disco (0 = siempre a disco)
+    QR_MEMORY_UPLOAD_MAX_MB = int(os.getenv('QR_MEMORY_UPLOAD_MAX_MB', '8'))
+    # Memoria total para archivos recibidos pendientes de procesar; el excedente va al spool
+    QR_MEMORY_UPLOAD_BUDGET_MB = int(os.getenv('QR_MEMORY_UPLOAD_BUDGET_MB', '256'))
+    # Carpeta de spool para archivos grandes (vacío = UPLOAD_FOLDER; /dev/shm evita el disco).
+    # Cada petición usa un subdirectorio propio que se elimina al terminar
+    QR_SPOOL_DIR = os.getenv('QR_SPOOL_DIR', '')
+    # Al iniciar un worker se eliminan los subdirectorios de procesos que ya no existen
+    # o sin modificar desde hace más de estos minutos (debe superar el timeout de gunicorn)
+    QR_SPOOL_MAX_AGE_MINUTES = int(os.getenv('QR_SPOOL_MAX_AGE_MINUTES', '120'))
     ALLOWED_EXTENSIONS = {
         'jpg', 'jpeg', 'png', 'bmp', 'tiff', 'tif', 
         'pdf', 'heic', 'heif'
@@ -21,7 +35,68 @@ class Config:
     
     # Configuración de procesamiento
     QR_DETECTION_CONFIDENCE = float(os.getenv('QR_DETECTION_CONFIDENCE', '0.6'))
-    MAX_QR_ATTEMPTS = int(os.getenv('MAX_QR_ATTEMPTS', '3'))
+    # Presupuesto por imagen: intentos de decodificación (una variante con un
+    # decodificador) y milisegundos; 0 = sin límite. Sobrescribible por petición
+    # con los campos 'maxAttempts' y 'timeBudgetMs'. Reemplaza a MAX_QR_ATTEMPTS
+    # (intentos por archivo), que se ignora: su valor habitual (3) agotaría el
+    # presupuesto antes de los recortes
+    QR_MAX_DECODE_ATTEMPTS = int(os.getenv('QR_MAX_DECODE_ATTEMPTS', '80'))
+    QR_TIME_BUDGET_MS = int(os.getenv('QR_TIME_BUDGET_MS', '20000'))
+    # Techo para los presupuestos solicitados por petición
+    QR_TIME_BUDGET_CEILING_MS = int(os.getenv('QR_TIME_BUDGET_CEILING_MS', '120000'))
+    # Intentos de la primera pasada sobre fotos decodificadas a resolución reducida
+    # (forman parte del presupuesto por imagen)
+    QR_REDUCED_PASS_MAX_ATTEMPTS = int(os.getenv('QR_REDUCED_PASS_MAX_ATTEMPTS', '12'))
+    # Intentos por imagen embebida del PDF (un QR generado digitalmente se lee al primero)
+    QR_PDF_IMAGE_MAX_ATTEMPTS = int(os.getenv('QR_PDF_IMAGE_MAX_ATTEMPTS', '6'))
+    
+    # Modo de detección QR: 'first_hit' (detenerse en el primer código) o 'exhaustive'
+    QR_DETECTION_MODE = os.getenv('QR_DETECTION_MODE', 'first_hit')
+    # Orden adaptativo de la cascada según el historial de éxitos por tipo de entrada
+    QR_ADAPTIVE_ORDER = os.getenv('QR_ADAPTIVE_ORDER', 'True').lower() == 'true'
+    QR_SCHEDULER_STATE = os.getenv('QR_SCHEDULER_STATE', os.path.join('temp', 'qr_scheduler.json'))
+    # Localizar regiones QR y decodificar primero sobre recortes
+    QR_LOCATE_REGIONS = os.getenv('QR_LOCATE_REGIONS', 'True').lower() == 'true'
+    # Intentar primero una versión reducida (lado mayor <= 1200 px) de imágenes grandes
+    QR_COARSE_TO_FINE = os.getenv('QR_COARSE_TO_FINE', 'True').lower() == 'true'
+    # Pre-chequeo de patrones de posición: sin candidatos se omite la cascada completa
+    QR_PRESENCE_CHECK = os.getenv('QR_PRESENCE_CHECK', 'False').lower() == 'true'
+    # Archivos sin candidatos QR pasan a OCR para leer el CUFE impreso (también 'ocrFallback'
+    # en la petición); activa el pre-chequeo para esos archivos aunque QR_PRESENCE_CHECK sea False
+    QR_OCR_FALLBACK = os.getenv('QR_OCR_FALLBACK', 'False').lower() == 'true'
+    # Hilos para evaluar variantes de una misma imagen en paralelo (0 = secuencial)
+    QR_PARALLEL_WORKERS = int(os.getenv('QR_PARALLEL_WORKERS', '0'))
+    # Decodificadores: perfil de utils.DECODER_PROFILES o lista separada por comas
+    # (pyzbar, opencv, opencv_aruco, wechat, zxing) en el orden en que se prueban
+    QR_DECODERS = os.getenv('QR_DECODERS', 'default')
+    
+    # Buscar el QR en las imágenes embebidas del PDF antes de rasterizar páginas y,
+    # si no se lee ningún QR, el CUFE en enlaces/capa de texto (requiere pypdfium2)
+    QR_PDF_CONTENT_FIRST = os.getenv('QR_PDF_CONTENT_FIRST', 'True').lower() == 'true'
+    # Resolución de trabajo máxima de fotos (megapíxeles): las mayores se decodifican
+    # reducidas 2x/4x/8x y solo si fallan se usa la resolución completa (0 = sin límite)
+    QR_MAX_DECODE_MEGAPIXELS = int(os.getenv('QR_MAX_DECODE_MEGAPIXELS', '12'))
+    # Hilos para decodificar por adelantado los HEIC de un lote (0 = en línea)
+    QR_HEIF_DECODE_WORKERS = int(os.getenv('QR_HEIF_DECODE_WORKERS', '2'))
+    # Renderizador de PDFs: pdfium (en proceso), pdf2image (poppler) o auto
+    PDF_RENDERER = os.getenv('PDF_RENDERER', 'auto')
+    # Resolución de renderizado de PDFs: primera pasada en escala de grises a
+    # QR_PDF_LOW_DPI y solo las páginas sin QR a QR_PDF_DPI (0 = una sola pasada)
+    QR_PDF_LOW_DPI = int(os.getenv('QR_PDF_LOW_DPI', '150'))
+    QR_PDF_DPI = int(os.getenv('QR_PDF_DPI', '300'))
+    
+    # Caché de resultados por SHA-256 del archivo (memoria + disco compartido)
+    QR_CACHE_ENABLED = os.getenv('QR_CACHE_ENABLED', 'True').lower() == 'true'
+    QR_CACHE_DIR = os.getenv('QR_CACHE_DIR', os.path.join('temp', 'qr_cache'))
+    QR_CACHE_MEMORY_ENTRIES = int(os.getenv('QR_CACHE_MEMORY_ENTRIES', '1024'))
+    QR_CACHE_MAX_DISK_MB = int(os.getenv('QR_CACHE_MAX_DISK_MB', '256'))
+    QR_CACHE_TTL_HOURS = int(os.getenv('QR_CACHE_TTL_HOURS', '720'))
+    
+    # Índice de casi-duplicados por hash perceptual: si una imagen se parece a una
+    # ya decodificada se prueba primero la región QR recordada
+    QR_DUPLICATE_INDEX = os.getenv('QR_DUPLICATE_INDEX', 'True').lower() == 'true'
+    QR_DUPLICATE_MAX_DISTANCE = int(os.getenv('QR_DUPLICATE_MAX_DISTANCE', '8'))
+    QR_DUPLICATE_MAX_ENTRIES = int(os.getenv('QR_DUPLICATE_MAX_ENTRIES', '5000'))
     
     # Patrones de extracción CUFE
     CUFE_PATTERNS = [
@@ -47,6 +122,8 @@ class Config:
         
         # Crear directorios necesarios
         os.makedirs(Config.UPLOAD_FOLDER, exist_ok=True)
+        if Config.QR_SPOOL_DIR:
+            os.makedirs(Config.QR_SPOOL_DIR, exist_ok=True)
         os.makedirs('temp', exist_ok=True)
 
 class DevelopmentConfig(Config):
@@ -59,6 +136,10 @@ class ProductionConfig(Config):
     DEBUG = False
     TESTING = False
     MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB en producción
+    # Presupuesto más estricto para no bloquear lotes grandes
+    QR_MAX_DECODE_ATTEMPTS = int(os.getenv('QR_MAX_DECODE_ATTEMPTS', '60'))
+    QR_TIME_BUDGET_MS = int(os.getenv('QR_TIME_BUDGET_MS', '10000'))
+    QR_TIME_BUDGET_CEILING_MS = int(os.getenv('QR_TIME_BUDGET_CEILING_MS', '60000'))
 
 class TestingConfig(Config):
     """Configuración para testing"""
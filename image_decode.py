@@ -0,0 +1,260 @@
+"""
+Decodificación de archivos directamente a escala de grises
+
+La detección QR solo usa luminancia: decodificar a un único canal evita el
+buffer RGB, la copia a NumPy y la conversión BGR -> gris de cada imagen.
+
+Todas las funciones aceptan como origen una ruta o el contenido del archivo
+en memoria (bytes): las subidas pequeñas se decodifican sin pasar por disco.
+"""
+import io
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+HEIF_TYPES = ('image/heic', 'image/heif')
+HEIF_EXTENSIONS = ('.heic', '.heif')
+
+# Flags de OpenCV para decodificar reduciendo la resolución en el propio decodificador
+_REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+
+_heif_registered = None
+_heif_lock = threading.Lock()
+
+def register_heif_support():
+    """
+    Registra el plugin HEIF de PIL una sola vez por proceso
+    
+    Se llama al importar el servidor (arranque de cada worker), no por archivo.
+    
+    Returns:
+        True si pillow-heif está disponible
+    """
+    global _heif_registered
+    with _heif_lock:
+        if _heif_registered is None:
+            try:
+                from pillow_heif import register_heif_opener
+                register_heif_opener()
+                _heif_registered = True
+            except ImportError:
+                logger.warning("pillow-heif no está instalado: no se podrán procesar archivos HEIC")
+                _heif_registered = False
+    return _heif_registered
+
+def is_path(source):
+    """True si el origen es una ruta (y no el contenido en memoria)"""
+    return isinstance(source, (str, os.PathLike))
+
+def open_source(source):
+    """Objeto que PIL/pillow-heif pueden abrir: la ruta o un BytesIO sobre el contenido"""
+    return source if is_path(source) else io.BytesIO(source)
+
+def is_heif(file_path, file_type=None):
+    if file_type in HEIF_TYPES:
+        return True
+    return is_path(file_path) and str(file_path).lower().endswith(HEIF_EXTENSIONS)
+
+def read_image_size(image_path):
+    """
+    Dimensiones (ancho, alto) leídas de la cabecera, sin decodificar píxeles
+    
+    Returns:
+        (ancho, alto) o None si no se pudo leer
+    """
+    try:
+        with Image.open(open_source(image_path)) as pil_image:
+            return pil_image.size
+    except Exception:
+        return None
+
+def reduction_for(size, max_megapixels):
+    """
+    Menor factor de reducción del decodificador (1, 2, 4 u 8) que deja la
+    imagen dentro de max_megapixels
+    
+    Args:
+        size: (ancho, alto) o None si se desconoce
+        max_megapixels: Límite de resolución de trabajo (0 = sin límite)
+    """
+    if not size or not max_megapixels:
+        return 1
+    megapixels = size[0] * size[1] / 1e6
+    for factor in (1, 2, 4):
+        if megapixels / factor ** 2 <= max_megapixels:
+            return factor
+    return 8
+
+def decode_image_gray(image_path, reduce=1):
+    """
+    Decodifica JPEG/PNG/BMP/TIFF a un array uint8 contiguo de un canal
+    
+    Args:
+        image_path: Ruta al archivo o su contenido (bytes)
+        reduce: Factor de reducción aplicado por el decodificador (1, 2, 4 u 8)
+    
+    Returns:
+        Array (alto, ancho) o None si no se pudo decodificar
+    """
+    # cv2.imread/imdecode aplican la orientación EXIF (salvo IMREAD_IGNORE_ORIENTATION)
+    flags = _REDUCED_GRAYSCALE.get(reduce, cv2.IMREAD_GRAYSCALE)
+    if is_path(image_path):
+        image = cv2.imread(image_path, flags)
+    else:
+        # np.frombuffer no copia el contenido recibido
+        image = cv2.imdecode(np.frombuffer(image_path, np.uint8), flags)
+    if image is not None:
+        return image
+    
+    # Formatos o variantes que OpenCV no decodifica (p. ej. algunos TIFF): PIL en modo L
+    try:
+        with Image.open(open_source(image_path)) as pil_image:
+            gray = ImageOps.exif_transpose(pil_image).convert('L')
+        if reduce > 1:
+            gray = gray.reduce(reduce)
+        return np.ascontiguousarray(np.asarray(gray))
+    except Exception as e:
+        logger.debug(f"No se pudo decodificar {image_path if is_path(image_path) else 'la imagen en memoria'}: {e}")
+        return None
+
+def decode_heif_gray(heif_path):
+    """
+    Decodifica la imagen principal de un HEIF/HEIC y conserva solo la luminancia
+    
+    El buffer decodificado por libheif se lee sin copiarlo a PIL y se reduce a
+    un canal en una sola conversión.
+    
+    Returns:
+        Array (alto, ancho) uint8
+    """
+    from pillow_heif import open_heif
+    
+    heif = open_heif(open_source(heif_path), convert_hdr_to_8bit=True)
+    return _heif_to_gray(np.asarray(heif))
+
+def _heif_to_gray(pixels):
+    if pixels.ndim == 2:
+        return np.ascontiguousarray(pixels)
+    code = cv2.COLOR_RGBA2GRAY if pixels.shape[2] == 4 else cv2.COLOR_RGB2GRAY
+    return cv2.cvtColor(pixels, code)
+
+def count_frames(file_path, file_type=None):
+    """
+    Número de páginas/imágenes de un TIFF multipágina o HEIF, leído de la cabecera
+    
+    Los demás formatos multi-frame de PIL cuentan como una imagen: un JPEG MPO
+    de celular trae la foto y una vista previa, y debe seguir el camino de JPEG
+    (decodificación reducida).
+    
+    Returns:
+        Número de frames (1 si el formato no es multi-frame o no se pudo leer)
+    """
+    try:
+        if is_heif(file_path, file_type):
+            from pillow_heif import open_heif
+            return len(open_heif(open_source(file_path)))
+        with Image.open(open_source(file_path)) as pil_image:
+            if pil_image.format != 'TIFF':
+                return 1
+            return getattr(pil_image, 'n_frames', 1)
+    except Exception:
+        return 1
+
+def iter_frames_gray(file_path, file_type=None, skip_primary=False):
+    """
+    Recorre los frames de un TIFF multipágina o HEIF de a uno, en escala de grises
+    
+    Cada frame se decodifica al pedirlo y se libera al avanzar, así la memoria
+    no crece con el número de páginas; el llamador puede detenerse en el
+    primer frame con QR.
+    
+    Args:
+        file_path: Ruta al archivo o su contenido (bytes)
+        file_type: Tipo MIME (opcional si es una ruta: si no se usa la extensión)
+        skip_primary: Omitir la imagen principal (ya procesada por separado)
+    
+    Yields:
+        (número de frame 1-indexado, array (alto, ancho) uint8)
+    """
+    if is_heif(file_path, file_type):
+        from pillow_heif import open_heif
+        heif = open_heif(open_source(file_path), convert_hdr_to_8bit=True)
+        for index in range(len(heif)):
+            if skip_primary and index == heif.primary_index:
+                continue
+            yield index + 1, _heif_to_gray(np.asarray(heif[index]))
+        return
+    
+    with Image.open(open_source(file_path)) as pil_image:
+        for index in range(getattr(pil_image, 'n_frames', 1)):
+            if skip_primary and index == 0:
+                continue
+            pil_image.seek(index)
+            # Orientación de cada página (etiqueta Orientation de TIFF/EXIF) con transposición sin pérdida
+            frame = ImageOps.exif_transpose(pil_image).convert('L')
+            yield index + 1, np.ascontiguousarray(np.asarray(frame))
+
+class DecodePool:
+    """
+    Pool acotado de decodificación anticipada
+    
+    Decodifica los próximos archivos del lote en hilos (libheif libera el GIL)
+    mientras el hilo principal detecta QR en el archivo actual. Como máximo
+    max_pending archivos quedan decodificados o en curso a la vez.
+    """
+    
+    def __init__(self, decode, max_workers=2, max_pending=None):
+        """
+        Args:
+            decode: Función origen (ruta o bytes) -> imagen a ejecutar en el pool
+            max_workers: Hilos de decodificación (0 = siempre en línea)
+            max_pending: Decodificaciones anticipadas simultáneas (por defecto max_workers)
+        """
+        self._decode = decode
+        self.max_pending = max_pending or max_workers
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='decode') if max_workers > 0 else None
+        self._futures = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _key(source):
+        # El contenido en memoria se identifica por objeto (el lote lo mantiene vivo)
+        return source if is_path(source) else id(source)
+    
+    def prefetch(self, source):
+        """Agenda la decodificación de source si hay capacidad; retorna True si se agendó"""
+        if self._executor is None:
+            return False
+        key = self._key(source)
+        with self._lock:
+            if key in self._futures or len(self._futures) >= self.max_pending:
+                return False
+            self._futures[key] = self._executor.submit(self._decode, source)
+        return True
+    
+    def decode(self, source):
+        """Resultado de la decodificación anticipada, o decodifica en línea si no se agendó"""
+        with self._lock:
+            future = self._futures.pop(self._key(source), None)
+        if future is not None:
+            return future.result()
+        return self._decode(source)
+    
+    def discard(self, source):
+        """Descarta una decodificación anticipada que no se va a consumir"""
+        with self._lock:
+            future = self._futures.pop(self._key(source), None)
+        if future is not None:
+            future.cancel()
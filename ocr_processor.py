@@ -2,11 +2,11 @@
 Módulo para procesamiento OCR de imágenes y PDFs
 """
 import os
-import cv2
 import numpy as np
 from PIL import Image
 import pytesseract
-from pdf2image import convert_from_path
+from pdf_render import iter_pdf_pages
+from image_decode import decode_image_gray
 import tempfile
 import time
 
@@ -22,27 +22,21 @@ class OCRProcessor:
         Extrae texto de una imagen usando OCR
         
         Args:
-            image_path: Ruta al archivo de imagen
+            image_path: Ruta al archivo de imagen o su contenido (bytes)
             lang: Idioma para OCR (spa=español, eng=inglés)
         
         Returns:
             dict con el texto extraído y metadatos
         """
         try:
-            # Leer imagen
-            image = cv2.imread(image_path)
-            if image is None:
+            # Leer imagen directamente en escala de grises
+            gray = decode_image_gray(image_path)
+            if gray is None:
                 return {
                     'success': False,
                     'error': 'No se pudo cargar la imagen'
                 }
             
-            # Convertir a escala de grises
-            if len(image.shape) == 3:
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = image.copy()
-            
             # Extraer texto usando OCR básico
             text = pytesseract.image_to_string(gray, lang=lang)
             
@@ -64,37 +58,31 @@ class OCRProcessor:
         Extrae texto de un PDF usando OCR
         
         Args:
-            pdf_path: Ruta al archivo PDF
+            pdf_path: Ruta al archivo PDF o su contenido (bytes)
             lang: Idioma para OCR
         
         Returns:
             dict con el texto extraído de todas las páginas
         """
         try:
-            # Convertir PDF a imágenes
-            images = convert_from_path(pdf_path, dpi=300)
-            
-            if not images:
-                return {
-                    'success': False,
-                    'error': 'No se pudieron convertir las páginas del PDF'
-                }
-            
             all_text = []
             
-            # Procesar cada página
-            for page_num, pil_image in enumerate(images):
-                # Convertir PIL Image a escala de grises
-                gray = pil_image.convert('L')
-                
+            # Procesar cada página (renderizada de a una, directamente en escala de grises)
+            for page_num, gray in iter_pdf_pages(pdf_path, dpi=300, grayscale=True):
                 # Extraer texto usando OCR básico
                 page_text = pytesseract.image_to_string(gray, lang=lang)
                 
                 all_text.append({
-                    'page': page_num + 1,
+                    'page': page_num,
                     'text': page_text.strip()
                 })
             
+            if not all_text:
+                return {
+                    'success': False,
+                    'error': 'No se pudieron convertir las páginas del PDF'
+                }
+            
             # Combinar texto de todas las páginas
             combined_text = '\n\n'.join([item['text'] for item in all_text])
             
@@ -102,7 +90,7 @@ class OCRProcessor:
                 'success': True,
                 'text': combined_text,
                 'pages': all_text,
-                'total_pages': len(images),
+                'total_pages': len(all_text),
                 'word_count': len(combined_text.split()),
                 'char_count': len(combined_text)
             }
@@ -118,7 +106,7 @@ class OCRProcessor:
         Procesa un archivo (imagen o PDF) y extrae texto usando OCR
         
         Args:
-            file_path: Ruta al archivo
+            file_path: Ruta al archivo o su contenido (bytes)
             file_type: Tipo MIME del archivo
             lang: Idioma para OCR
         
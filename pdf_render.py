@@ -0,0 +1,358 @@
+"""
+Rasterización de PDFs página a página y lectura de su contenido embebido
+
+Los renderizadores producen arrays de NumPy (BGR o escala de grises) para
+que el llamador pase la página directamente a OpenCV:
+
+- pdfium: en proceso con pypdfium2 (sin subprocesos, PNG ni archivos temporales)
+- pdf2image: poppler pdftoppm como subproceso (respaldo si pypdfium2 no está instalado)
+
+El PDF puede indicarse por ruta o por su contenido en memoria (bytes).
+"""
+import os
+import re
+import ctypes
+import logging
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+except ImportError:
+    pdfium = None
+
+logger = logging.getLogger(__name__)
+
+# PDFium no es seguro entre hilos: todas las llamadas se serializan
+_PDFIUM_LOCK = threading.RLock()
+
+class PdfRenderer:
+    """Renderizador de páginas PDF a arrays de NumPy"""
+    
+    name = ''
+    
+    def is_available(self):
+        return True
+    
+    def page_count(self, pdf_path):
+        """Número de páginas del PDF (sin rasterizar)"""
+        raise NotImplementedError
+    
+    def page_sizes(self, pdf_path):
+        """Tamaño (ancho, alto) en puntos de cada página, leído de la estructura del PDF"""
+        raise NotImplementedError
+    
+    def render_page(self, pdf_path, page_number, dpi=300, grayscale=False):
+        """
+        Rasteriza una sola página
+        
+        Args:
+            pdf_path: Ruta al archivo PDF o su contenido (bytes)
+            page_number: Página 1-indexada
+            dpi: Resolución de renderizado
+            grayscale: Renderizar directamente en escala de grises
+        
+        Returns:
+            Array BGR (o de un canal si grayscale), o None si la página no existe
+        """
+        raise NotImplementedError
+    
+    def iter_pages(self, pdf_path, dpi=300, grayscale=False, first_page=1, last_page=None):
+        page_count = self.page_count(pdf_path)
+        if last_page is None or last_page > page_count:
+            last_page = page_count
+        
+        for page_number in range(first_page, last_page + 1):
+            page = self.render_page(pdf_path, page_number, dpi=dpi, grayscale=grayscale)
+            if page is not None:
+                yield page_number, page
+
+class PdfiumRenderer(PdfRenderer):
+    """Renderizado en proceso con pypdfium2"""
+    
+    name = 'pdfium'
+    
+    def is_available(self):
+        return pdfium is not None
+    
+    def page_count(self, pdf_path):
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+    
+    def page_sizes(self, pdf_path):
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                return [pdf.get_page_size(index) for index in range(len(pdf))]
+            finally:
+                pdf.close()
+    
+    def render_page(self, pdf_path, page_number, dpi=300, grayscale=False):
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                if not 1 <= page_number <= len(pdf):
+                    return None
+                return self._render(pdf, page_number - 1, dpi, grayscale)
+            finally:
+                pdf.close()
+    
+    def iter_pages(self, pdf_path, dpi=300, grayscale=False, first_page=1, last_page=None):
+        # El documento queda abierto entre páginas; el lock solo se toma al renderizar
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            page_count = len(pdf)
+            if last_page is None or last_page > page_count:
+                last_page = page_count
+            for page_number in range(first_page, last_page + 1):
+                with _PDFIUM_LOCK:
+                    page = self._render(pdf, page_number - 1, dpi, grayscale)
+                yield page_number, page
+        finally:
+            with _PDFIUM_LOCK:
+                pdf.close()
+    
+    @staticmethod
+    def _render(pdf, index, dpi, grayscale):
+        page = pdf[index]
+        try:
+            bitmap = page.render(scale=dpi / 72, grayscale=grayscale)
+            # Copia propia: el buffer del bitmap pertenece a PDFium
+            image = np.array(bitmap.to_numpy())
+            bitmap.close()
+        finally:
+            page.close()
+        if image.ndim == 3 and image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+        return image
+
+class Pdf2ImageRenderer(PdfRenderer):
+    """Renderizado con poppler (pdftoppm) vía pdf2image"""
+    
+    name = 'pdf2image'
+    
+    def is_available(self):
+        try:
+            import pdf2image  # noqa: F401
+            return True
+        except ImportError:
+            return False
+    
+    @staticmethod
+    def _pdfinfo(pdf_path):
+        from pdf2image import pdfinfo_from_path, pdfinfo_from_bytes
+        if isinstance(pdf_path, (str, os.PathLike)):
+            return pdfinfo_from_path(pdf_path)
+        return pdfinfo_from_bytes(pdf_path)
+    
+    def page_count(self, pdf_path):
+        return int(self._pdfinfo(pdf_path)['Pages'])
+    
+    def page_sizes(self, pdf_path):
+        # pdfinfo solo informa el tamaño de la primera página ('612 x 792 pts (letter)')
+        info = self._pdfinfo(pdf_path)
+        width, height = 612.0, 792.0
+        match = re.match(r'\s*([\d.]+)\s*x\s*([\d.]+)', info.get('Page size', ''))
+        if match:
+            width, height = float(match.group(1)), float(match.group(2))
+        return [(width, height)] * int(info['Pages'])
+    
+    def render_page(self, pdf_path, page_number, dpi=300, grayscale=False):
+        from pdf2image import convert_from_path, convert_from_bytes
+        convert = convert_from_path if isinstance(pdf_path, (str, os.PathLike)) else convert_from_bytes
+        pages = convert(pdf_path, dpi=dpi, fmt='ppm', grayscale=grayscale,
+                        first_page=page_number, last_page=page_number)
+        if not pages:
+            return None
+        image = np.array(pages[0])
+        pages[0].close()
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        return image
+
+RENDERERS = {renderer.name: renderer for renderer in (PdfiumRenderer(), Pdf2ImageRenderer())}
+_default_renderer = None
+
+def set_default_renderer(name='auto'):
+    """
+    Selecciona el renderizador usado por las funciones del módulo
+    
+    Args:
+        name: 'pdfium', 'pdf2image' o 'auto' (pdfium si está instalado)
+    """
+    global _default_renderer
+    _default_renderer = None
+    if name != 'auto':
+        renderer = RENDERERS.get(name)
+        if renderer is not None and renderer.is_available():
+            _default_renderer = renderer
+        else:
+            logger.warning(f"Renderizador PDF '{name}' no disponible, se usa selección automática")
+    return get_renderer()
+
+def get_renderer():
+    """Renderizador por defecto (pdfium si está instalado, si no pdf2image)"""
+    global _default_renderer
+    if _default_renderer is None:
+        _default_renderer = next((renderer for renderer in RENDERERS.values() if renderer.is_available()),
+                                 RENDERERS['pdf2image'])
+    return _default_renderer
+
+def get_page_count(pdf_path):
+    """Número de páginas del PDF (sin rasterizar)"""
+    return get_renderer().page_count(pdf_path)
+
+def get_page_sizes(pdf_path):
+    """Tamaño (ancho, alto) en puntos de cada página (sin rasterizar)"""
+    return get_renderer().page_sizes(pdf_path)
+
+def render_pdf_page(pdf_path, page_number, dpi=300, grayscale=False):
+    """
+    Rasteriza una sola página del PDF
+    
+    Returns:
+        Array BGR (o de un canal si grayscale), o None si la página no existe
+    """
+    return get_renderer().render_page(pdf_path, page_number, dpi=dpi, grayscale=grayscale)
+
+def iter_pdf_pages(pdf_path, dpi=300, grayscale=False, first_page=1, last_page=None):
+    """
+    Rasteriza un PDF de a una página por vez
+    
+    Solo hay una página en memoria: el llamador puede detenerse en cuanto
+    encuentra lo que busca y las páginas restantes nunca se renderizan.
+    
+    Args:
+        pdf_path: Ruta al archivo PDF o su contenido (bytes)
+        dpi: Resolución de renderizado
+        grayscale: Renderizar directamente en escala de grises
+        first_page: Primera página (1-indexada)
+        last_page: Última página incluida (None = hasta el final)
+    
+    Yields:
+        (número de página 1-indexado, array BGR o de un canal)
+    """
+    return get_renderer().iter_pages(pdf_path, dpi=dpi, grayscale=grayscale,
+                                     first_page=first_page, last_page=last_page)
+
+def page_to_pil(page):
+    """Convierte una página renderizada a PIL Image (RGB o L)"""
+    if page.ndim == 2:
+        return Image.fromarray(page)
+    return Image.fromarray(cv2.cvtColor(page, cv2.COLOR_BGR2RGB))
+
+def iter_pdf_text(pdf_path):
+    """
+    Recorre la capa de texto y los enlaces (anotaciones URI) de cada página
+    
+    Requiere pypdfium2; sin él no produce nada.
+    
+    Yields:
+        (número de página 1-indexado, texto de la página, lista de URIs)
+    """
+    if pdfium is None:
+        return
+    
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for index in range(len(pdf)):
+            with _PDFIUM_LOCK:
+                page = pdf[index]
+                textpage = page.get_textpage()
+                try:
+                    text = textpage.get_text_bounded()
+                finally:
+                    textpage.close()
+                uris = _page_link_uris(pdf, page)
+                page.close()
+            yield index + 1, text, uris
+    finally:
+        with _PDFIUM_LOCK:
+            pdf.close()
+
+def iter_pdf_images(pdf_path, min_side=50, max_aspect=2.5, max_images=20, max_page_coverage=0.5):
+    """
+    Recorre las imágenes embebidas (XObject) a su resolución nativa
+    
+    Solo se consideran imágenes con forma compatible con un código QR
+    (lado menor >= min_side, proporción <= max_aspect) que ocupan como mucho
+    max_page_coverage del área de la página: la página completa de un PDF
+    escaneado es una sola imagen y se procesa al rasterizar. Requiere pypdfium2.
+    
+    Yields:
+        (número de página 1-indexado, imagen BGR o en escala de grises)
+    """
+    if pdfium is None:
+        return
+    
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_path)
+    yielded = 0
+    try:
+        for index in range(len(pdf)):
+            with _PDFIUM_LOCK:
+                images = _page_images(pdf, index, min_side, max_aspect, max_page_coverage)
+            for image in images:
+                yield index + 1, image
+                yielded += 1
+                if yielded >= max_images:
+                    return
+    finally:
+        with _PDFIUM_LOCK:
+            pdf.close()
+
+def _page_images(pdf, index, min_side, max_aspect, max_page_coverage):
+    """Imágenes embebidas de una página con forma y tamaño compatibles con un QR"""
+    images = []
+    page = pdf[index]
+    try:
+        page_width, page_height = page.get_size()
+        page_area = page_width * page_height
+        for obj in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,)):
+            width, height = obj.get_px_size()
+            if min(width, height) < min_side or max(width, height) > max_aspect * min(width, height):
+                continue
+            # get_bounds en pypdfium2 >= 5, get_pos en versiones anteriores
+            left, bottom, right, top = (obj.get_bounds() if hasattr(obj, 'get_bounds') else obj.get_pos())
+            if page_area > 0 and (right - left) * (top - bottom) > max_page_coverage * page_area:
+                continue
+            try:
+                # Bitmap ajeno (de PDFium): se copia y se deja al recolector, sin close()
+                bitmap = obj.get_bitmap(render=False)
+                image = np.array(bitmap.to_numpy())
+            except Exception as e:
+                logger.debug(f"No se pudo extraer una imagen de la página {index + 1}: {e}")
+                continue
+            if image.ndim == 3 and image.shape[2] == 4:
+                image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+            images.append(image)
+    finally:
+        page.close()
+    return images
+
+def _page_link_uris(pdf, page):
+    """URIs de las anotaciones de enlace de una página"""
+    uris = []
+    position = ctypes.c_int(0)
+    link = pdfium_c.FPDF_LINK()
+    while pdfium_c.FPDFLink_Enumerate(page, ctypes.byref(position), ctypes.byref(link)):
+        action = pdfium_c.FPDFLink_GetAction(link)
+        if not action or pdfium_c.FPDFAction_GetType(action) != pdfium_c.PDFACTION_URI:
+            continue
+        length = pdfium_c.FPDFAction_GetURIPath(pdf, action, None, 0)
+        if length <= 1:
+            continue
+        buffer = ctypes.create_string_buffer(length)
+        pdfium_c.FPDFAction_GetURIPath(pdf, action, buffer, length)
+        uris.append(buffer.value.decode('utf-8', errors='replace'))
+    return uris
@@ -0,0 +1,298 @@
+"""
+Caché de resultados de detección QR por contenido de archivo
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Versión del pipeline de detección: cambiarla invalida los resultados en caché
+PIPELINE_VERSION = '1'
+
+class ResultCache:
+    """
+    Caché de resultados en dos niveles, indexada por SHA-256 del archivo
+    
+    - Nivel en memoria: LRU por proceso
+    - Nivel en disco: un JSON por entrada, compartido entre workers de gunicorn
+    
+    Ambos niveles expiran por TTL; el nivel en disco además se poda por tamaño.
+    """
+    
+    def __init__(self, directory, max_memory_entries=1024, max_disk_bytes=256 * 1024 * 1024,
+                 ttl_seconds=30 * 24 * 3600, version=PIPELINE_VERSION):
+        """
+        Args:
+            directory: Carpeta del nivel en disco (None = solo memoria)
+            max_memory_entries: Entradas máximas del LRU en memoria
+            max_disk_bytes: Tamaño máximo del nivel en disco
+            ttl_seconds: Vida de cada entrada en segundos
+            version: Versión del pipeline incluida en la clave
+        """
+        self.directory = directory
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.version = version
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_prune = 0
+        self.hits = 0
+        self.misses = 0
+        
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    
+    def key_for_bytes(self, data):
+        """Clave de caché para un contenido en memoria"""
+        return f"{self.version}-{hashlib.sha256(data).hexdigest()}"
+    
+    def key_for_file(self, file_path, chunk_size=1024 * 1024):
+        """Clave de caché para un archivo en disco (lectura por bloques)"""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return f"{self.version}-{digest.hexdigest()}"
+    
+    def get(self, key):
+        """
+        Obtiene un resultado de la caché
+        
+        Returns:
+            dict con el resultado (copia independiente) o None si no existe o expiró
+        """
+        now = time.time()
+        
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, payload = entry
+                if now - stored_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(payload)
+                del self._memory[key]
+        
+        payload, stored_at = self._read_disk(key, now)
+        with self._lock:
+            if payload is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, stored_at, payload)
+        return json.loads(payload)
+    
+    def set(self, key, result):
+        """Guarda un resultado en ambos niveles"""
+        try:
+            payload = json.dumps(result)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Resultado no serializable para la caché: {e}")
+            return
+        
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, payload)
+            self._writes_since_prune += 1
+            should_prune = self._writes_since_prune >= 50
+            if should_prune:
+                self._writes_since_prune = 0
+        
+        self._write_disk(key, payload)
+        if should_prune:
+            self.prune()
+    
+    def prune(self):
+        """Elimina entradas expiradas del disco y las más antiguas si se supera el tamaño"""
+        if not self.directory:
+            return
+        
+        now = time.time()
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                self._remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+        
+        # Eliminar primero las más antiguas hasta respetar el tamaño máximo
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= self.max_disk_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+    
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total * 100, 2) if total else 0,
+                'memory_entries': len(self._memory)
+            }
+    
+    def _remember(self, key, stored_at, payload):
+        """Inserta en el LRU en memoria (requiere el lock tomado)"""
+        self._memory[key] = (stored_at, payload)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+    
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+    
+    def _read_disk(self, key, now):
+        if not self.directory:
+            return None, None
+        path = self._path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if now - stored_at > self.ttl_seconds:
+                self._remove(path)
+                return None, None
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read(), stored_at
+        except OSError:
+            return None, None
+    
+    def _write_disk(self, key, payload):
+        if not self.directory:
+            return
+        # Escritura atómica: otros workers nunca leen un archivo a medias
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"No se pudo escribir en la caché de resultados: {e}")
+            self._remove(tmp_path)
+    
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def hamming_distance(a, b):
+    """Número de bits distintos entre dos hashes enteros"""
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """Árbol BK sobre distancia de Hamming para búsquedas por vecindad"""
+    
+    def __init__(self):
+        # Nodo: (hash, payload, {distancia: nodo hijo})
+        self.root = None
+        self.size = 0
+    
+    def add(self, value, payload):
+        node = (value, payload, {})
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming_distance(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+    
+    def search(self, value, max_distance):
+        """
+        Returns:
+            Lista de (distancia, payload) con distancia <= max_distance,
+            ordenada de más cercano a más lejano
+        """
+        if self.root is None:
+            return []
+        matches = []
+        pending = [self.root]
+        while pending:
+            node_value, payload, children = pending.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                matches.append((distance, payload))
+            # Desigualdad triangular: solo los hijos en [d - r, d + r] pueden coincidir
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    pending.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+class NearDuplicateIndex:
+    """
+    Índice de documentos ya decodificados por hash perceptual
+    
+    Permite reconocer re-escaneos o JPEG re-guardados de una factura ya vista
+    (que un hash de bytes no detecta) y recordar dónde estaba su código QR.
+    """
+    
+    def __init__(self, max_distance=8, max_entries=5000):
+        """
+        Args:
+            max_distance: Bits distintos (de 64) para considerar dos imágenes casi iguales
+            max_entries: Entradas máximas; al superarlas se conserva la mitad más reciente
+        """
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._entries = []
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.lookups = 0
+    
+    def find(self, value):
+        """
+        Busca el documento más parecido
+        
+        Returns:
+            payload del vecino más cercano dentro de max_distance, o None
+        """
+        with self._lock:
+            self.lookups += 1
+            matches = self._tree.search(value, self.max_distance)
+            if not matches:
+                return None
+            self.hits += 1
+            return matches[0][1]
+    
+    def add(self, value, payload):
+        with self._lock:
+            self._entries.append((value, payload))
+            self._tree.add(value, payload)
+            if len(self._entries) > self.max_entries:
+                # El árbol BK no admite borrado: reconstruir con las entradas recientes
+                self._entries = self._entries[len(self._entries) // 2:]
+                self._tree = BKTree()
+                for entry_value, entry_payload in self._entries:
+                    self._tree.add(entry_value, entry_payload)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': self._tree.size,
+                'lookups': self.lookups,
+                'hits': self.hits
+            }
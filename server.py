@@ -3,18 +3,21 @@ from flask_cors import CORS
 import os
 import tempfile
 import cv2
-import numpy as np
 from pyzbar import pyzbar
-from pdf2image import convert_from_path
-from PIL import Image
-from pillow_heif import register_heif_opener
+from pdf_render import iter_pdf_pages, iter_pdf_text, iter_pdf_images, render_pdf_page, set_default_renderer
 import json
 import re
 import time
+import atexit
 from werkzeug.utils import secure_filename
-from utils import QRProcessor, CUFEExtractor, InvoiceAnalyzer, validate_file_type, format_file_size
+from utils import QRProcessor, MethodScheduler, DetectionResult, DECODER_REGISTRY, CUFEExtractor, InvoiceAnalyzer, validate_file_type, format_file_size
 from config import config
 from ocr_processor import ocr_processor
+from qr_cache import ResultCache, NearDuplicateIndex
+from batch_planner import BatchPlanner, prescan_file
+from upload_stream import UploadReceiver, RequestSpool, sweep_spool
+from image_decode import (decode_image_gray, decode_heif_gray, read_image_size, reduction_for,
+                          is_heif, is_path, register_heif_support, DecodePool, count_frames, iter_frames_gray)
 
 app = Flask(__name__)
 
@@ -26,14 +29,67 @@ app.config.from_object(config[config_name])
 # Inicializar configuración
 config[config_name].init_app(app)
 
+if os.getenv('MAX_QR_ATTEMPTS'):
+    print('MAX_QR_ATTEMPTS ya no se usa: el presupuesto por imagen se configura con '
+          f"QR_MAX_DECODE_ATTEMPTS (actual: {app.config.get('QR_MAX_DECODE_ATTEMPTS')})")
+
+# Spool de subidas: cada petición usa su propio subdirectorio. Al iniciar el worker
+# se eliminan los de peticiones que no terminaron (worker reiniciado o caído)
+SPOOL_ROOT = app.config.get('QR_SPOOL_DIR') or app.config['UPLOAD_FOLDER']
+swept = sweep_spool(SPOOL_ROOT, app.config.get('QR_SPOOL_MAX_AGE_MINUTES', 120) * 60)
+if swept:
+    print(f'Spool: {swept} carpeta(s) huérfana(s) eliminada(s) de {SPOOL_ROOT}')
+
 # Configurar CORS
 cors_origins = config[config_name].CORS_ORIGINS if hasattr(config[config_name], 'CORS_ORIGINS') else ['*']
 CORS(app, origins=cors_origins)
 
 # Inicializar procesadores
-qr_processor = QRProcessor()
+set_default_renderer(app.config.get('PDF_RENDERER', 'auto'))
+# Soporte HEIF registrado una vez por worker; los HEIC del lote se decodifican por
+# adelantado en un pool acotado mientras se detecta el QR del archivo anterior
+register_heif_support()
+heif_decode_pool = DecodePool(decode_heif_gray, max_workers=app.config.get('QR_HEIF_DECODE_WORKERS', 0))
 cufe_extractor = CUFEExtractor()
+qr_scheduler = None
+if app.config.get('QR_ADAPTIVE_ORDER'):
+    qr_scheduler = MethodScheduler(state_path=app.config.get('QR_SCHEDULER_STATE'))
+    atexit.register(qr_scheduler.save)
+qr_decoders = app.config.get('QR_DECODERS', 'default')
+if ',' in qr_decoders:
+    qr_decoders = [name.strip() for name in qr_decoders.split(',') if name.strip()]
+# Índice de casi-duplicados (re-escaneos de facturas ya procesadas en este worker)
+duplicate_index = None
+if app.config.get('QR_DUPLICATE_INDEX'):
+    duplicate_index = NearDuplicateIndex(
+        max_distance=app.config.get('QR_DUPLICATE_MAX_DISTANCE', 8),
+        max_entries=app.config.get('QR_DUPLICATE_MAX_ENTRIES', 5000)
+    )
+qr_processor = QRProcessor(
+    scheduler=qr_scheduler,
+    locate_regions=app.config.get('QR_LOCATE_REGIONS', True),
+    coarse_to_fine=app.config.get('QR_COARSE_TO_FINE', True),
+    parallel_workers=app.config.get('QR_PARALLEL_WORKERS', 0),
+    # Solo un QR con CUFE/CUDE de la DIAN (96 hexadecimales) detiene la búsqueda (y
+    # cancela variantes en paralelo); extract_cufe acepta cualquier texto largo
+    hit_validator=lambda code: cufe_extractor.find_document_key(code) is not None,
+    decoders=qr_decoders,
+    duplicate_index=duplicate_index,
+    presence_check=app.config.get('QR_PRESENCE_CHECK', False)
+)
+
+# Caché de resultados por contenido (memoria del proceso + disco compartido entre workers)
+result_cache = None
+if app.config.get('QR_CACHE_ENABLED'):
+    result_cache = ResultCache(
+        app.config.get('QR_CACHE_DIR'),
+        max_memory_entries=app.config.get('QR_CACHE_MEMORY_ENTRIES', 1024),
+        max_disk_bytes=app.config.get('QR_CACHE_MAX_DISK_MB', 256) * 1024 * 1024,
+        ttl_seconds=app.config.get('QR_CACHE_TTL_HOURS', 720) * 3600
+    )
 invoice_analyzer = InvoiceAnalyzer()
+# Modelo de costo para ordenar lotes y estimar tiempo restante (calibrado por worker)
+batch_planner = BatchPlanner()
 
 # Estadísticas globales de procesamiento
 STATS = {
@@ -41,87 +97,404 @@ STATS = {
     'successful_detections': 0,
     'failed_detections': 0,
     'by_file_type': {},
+    'by_method': {},
+    'budget_exhausted': 0,
+    'cache_hits': 0,
     'processing_times': []
 }
 
 def allowed_file(filename):
     return validate_file_type(filename, '')
 
-def extract_qr_from_image(image_path):
-    """Extrae códigos QR de imágenes usando múltiples algoritmos mejorados"""
+def _positive_int(value, default):
+    """Convierte un parámetro de la petición a entero positivo o retorna el valor por defecto"""
     try:
-        # Leer imagen con OpenCV
-        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+def get_detection_options(form=None):
+    """
+    Construye las opciones de detección QR a partir de la configuración
+    y de los parámetros opcionales de la petición
+    
+    Args:
+        form: Formulario de la petición (puede incluir 'mode', 'maxAttempts'
+              y 'timeBudgetMs' para sobrescribir el presupuesto por imagen)
+        
+    Returns:
+        dict con los argumentos para QRProcessor.detect
+    """
+    mode = app.config.get('QR_DETECTION_MODE', QRProcessor.MODE_FIRST_HIT)
+    max_attempts = app.config.get('QR_MAX_DECODE_ATTEMPTS', 0)
+    max_time_ms = app.config.get('QR_TIME_BUDGET_MS', 0)
+    
+    if form is not None:
+        mode = form.get('mode', mode) or mode
+        max_attempts = _positive_int(form.get('maxAttempts'), max_attempts)
+        max_time_ms = _positive_int(form.get('timeBudgetMs'), max_time_ms)
+    if mode not in QRProcessor.DETECTION_MODES:
+        mode = QRProcessor.MODE_FIRST_HIT
+    
+    # Nunca superar el techo del servidor (evita bloquear el lote y el timeout de gunicorn)
+    time_ceiling = app.config.get('QR_TIME_BUDGET_CEILING_MS', 0)
+    if time_ceiling and (not max_time_ms or max_time_ms > time_ceiling):
+        max_time_ms = time_ceiling
+    
+    return {
+        'mode': mode,
+        'max_attempts': max_attempts,
+        'max_time_ms': max_time_ms
+    }
+
+def detection_error(detection, not_found_message):
+    """Mensaje de error según el estado de la detección"""
+    if detection.budget_exhausted:
+        return (f"Presupuesto de detección agotado ({detection.attempts} intentos, "
+                f"{detection.elapsed_ms / 1000:.1f} s) sin encontrar códigos QR")
+    if detection.status == DetectionResult.STATUS_NO_CANDIDATE:
+        return "No se encontraron patrones de código QR en la imagen"
+    return not_found_message
+
+def extract_qr_from_image(image_path, detection_options=None):
+    """
+    Extrae códigos QR de imágenes usando múltiples algoritmos mejorados
+    
+    Returns:
+        (qr_data, error, detection_info) donde detection_info describe el
+        recorrido de la detección (estado, intentos, tiempo, método)
+    """
+    try:
+        # TIFF multipágina (escáneres): frame a frame como las páginas de un PDF
+        if count_frames(image_path) > 1:
+            return extract_qr_from_frames(image_path, detection_options)
+        
+        # Decodificar directamente a escala de grises (la detección solo usa luminancia).
+        # Las fotos muy grandes se reducen en el propio decodificador (escalado en el
+        # dominio DCT para JPEG) hasta QR_MAX_DECODE_MEGAPIXELS.
+        reduce = reduction_for(read_image_size(image_path), app.config.get('QR_MAX_DECODE_MEGAPIXELS', 0))
+        image = decode_image_gray(image_path, reduce=reduce)
         if image is None:
-            # Intentar leer como escala de grises si falla
-            image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-            if image is None:
-                return None, "No se pudo cargar la imagen"
+            return None, "No se pudo cargar la imagen", None
         
-        # Usar el procesador mejorado que prueba múltiples métodos
-        qr_codes = qr_processor.detect_qr_codes(image)
+        # Usar el procesador mejorado que prueba múltiples métodos. Sobre la versión
+        # reducida es solo un primer vistazo con pocos intentos.
+        options = dict(detection_options or {})
+        if reduce > 1:
+            reduced_attempts = app.config.get('QR_REDUCED_PASS_MAX_ATTEMPTS', 12)
+            options['max_attempts'] = min(options.get('max_attempts') or reduced_attempts, reduced_attempts)
+        detection = qr_processor.detect(image, **options)
         
-        if qr_codes:
+        # Si la versión reducida falla, decodificar a tamaño completo y buscar solo en
+        # las regiones candidatas localizadas sobre la reducida (sin candidatos no hay
+        # nada que refinar)
+        if not detection.codes and reduce > 1 and detection.status != DetectionResult.STATUS_NO_CANDIDATE:
+            detection = detect_full_resolution(image_path, image, reduce, detection_options, spent=detection)
+            if detection is None:
+                return None, "No se pudo cargar la imagen", None
+        
+        detection_info = dict(detection.to_dict(), decode_reduction=reduce)
+        if detection.codes:
             # Retornar el primer código QR encontrado
-            return qr_codes[0], None
+            return detection.codes[0], None, detection_info
         else:
-            return None, "No se encontraron códigos QR"
+            return None, detection_error(detection, "No se encontraron códigos QR"), detection_info
             
     except Exception as e:
-        return None, f"Error al procesar imagen: {str(e)}"
+        return None, f"Error al procesar imagen: {str(e)}", None
+
+def extract_qr_from_frames(file_path, detection_options=None, skip_primary=False, file_type=None):
+    """
+    Extrae códigos QR de un TIFF multipágina o HEIF multi-imagen frame a frame
+    
+    Cada frame se decodifica en escala de grises y se descarta antes del
+    siguiente; la búsqueda se detiene en el primer frame con QR.
+    """
+    detection_info = None
+    budget_exhausted = False
+    for frame_number, frame in iter_frames_gray(file_path, file_type, skip_primary=skip_primary):
+        detection = qr_processor.detect(frame, **(detection_options or {}))
+        detection_info = dict(detection.to_dict(), frame=frame_number)
+        budget_exhausted = budget_exhausted or detection.budget_exhausted
+        
+        if detection.codes:
+            # Retornar el primer código QR encontrado
+            return detection.codes[0], None, detection_info
+    
+    if detection_info is None:
+        return None, "El archivo no tiene imágenes", None
+    if budget_exhausted:
+        detection_info['status'] = DetectionResult.STATUS_BUDGET_EXHAUSTED
+        return None, "Presupuesto de detección agotado sin encontrar códigos QR", detection_info
+    return None, "No se encontraron códigos QR", detection_info
+
+def remaining_budget(detection_options, attempts, start):
+    """
+    Opciones de detección con lo que queda del presupuesto por imagen
+    
+    Args:
+        detection_options: Opciones con el presupuesto completo (0 = sin límite)
+        attempts: Intentos ya consumidos en esta imagen
+        start: time.perf_counter() al comenzar la imagen
+    
+    Returns:
+        dict de opciones, o None si algún límite configurado ya se agotó
+    """
+    options = dict(detection_options or {})
+    if options.get('max_attempts'):
+        options['max_attempts'] -= attempts
+        if options['max_attempts'] <= 0:
+            return None
+    if options.get('max_time_ms'):
+        options['max_time_ms'] -= (time.perf_counter() - start) * 1000
+        if options['max_time_ms'] <= 0:
+            return None
+    return options
+
+def detect_full_resolution(image_path, reduced, reduce, detection_options=None, spent=None):
+    """
+    Segunda pasada a resolución completa para una imagen decodificada reducida
+    
+    El presupuesto por imagen (intentos y milisegundos de detection_options)
+    es uno solo para las dos pasadas: los recortes usan lo que dejó la pasada
+    reducida y se lo reparten en orden.
+    
+    Args:
+        spent: DetectionResult de la pasada reducida (sus intentos y su tiempo
+               ya se consumieron del presupuesto)
+    
+    Returns:
+        DetectionResult con los totales de la imagen (o None si no pudo decodificarse)
+    """
+    max_attempts = (detection_options or {}).get('max_attempts') or 0
+    max_time_ms = (detection_options or {}).get('max_time_ms') or 0
+    attempts = spent.attempts if spent is not None else 0
+    start = time.perf_counter() - (spent.elapsed_ms / 1000 if spent is not None else 0)
+    
+    regions = qr_processor.locate_qr_regions(reduced)
+    full = decode_image_gray(image_path)
+    if full is None:
+        return None
+    
+    # Sin regiones candidatas: la imagen completa como último recurso
+    targets = [full[y * reduce:(y + h) * reduce, x * reduce:(x + w) * reduce]
+               for x, y, w, h in regions] or [full]
+    detection = spent
+    exhausted = False
+    for target in targets:
+        options = remaining_budget(detection_options, attempts, start)
+        if options is None:
+            exhausted = True
+            break
+        
+        detection = qr_processor.detect(target, **options)
+        attempts += detection.attempts
+        if detection.codes:
+            break
+        exhausted = detection.status == DetectionResult.STATUS_BUDGET_EXHAUSTED
+    
+    if detection is None:
+        return None
+    # Totales de la imagen (ambas pasadas) frente a su presupuesto
+    detection.attempts = attempts
+    detection.elapsed_ms = (time.perf_counter() - start) * 1000
+    detection.max_attempts = max_attempts or None
+    detection.max_time_ms = max_time_ms or None
+    if exhausted and not detection.codes:
+        detection.status = DetectionResult.STATUS_BUDGET_EXHAUSTED
+    return detection
+
+# Consulta pública de la DIAN: el frontend toma el CUFE después de 'documentkey='
+DIAN_DOCUMENT_URL = 'https://catalogo-vpfe.dian.gov.co/document/searchqr?documentkey='
+
+def document_key_qr_data(cufe):
+    """qrData para un CUFE leído fuera del QR (texto del PDF u OCR): la URL de consulta de la DIAN"""
+    return f"{DIAN_DOCUMENT_URL}{cufe}"
+
+def extract_qr_from_pdf_images(pdf_path, detection_options=None):
+    """
+    Decodifica el QR de las imágenes embebidas del PDF sin rasterizar páginas
+    
+    Las facturas electrónicas generadas por proveedores tecnológicos suelen
+    traer el QR como imagen embebida, que se decodifica a su resolución nativa.
+    Es solo un camino rápido: pocos intentos por imagen y sin las imágenes de
+    página completa de los PDFs escaneados, que se procesan al rasterizar.
+    
+    Returns:
+        (qr_data, detection_info) o (None, None) si no se encontró nada
+    """
+    options = dict(detection_options or {})
+    image_attempts = app.config.get('QR_PDF_IMAGE_MAX_ATTEMPTS', 6)
+    options['max_attempts'] = min(options.get('max_attempts') or image_attempts, image_attempts)
+    
+    # Con margen blanco: las imágenes embebidas suelen no traer zona de silencio
+    for page_number, image in iter_pdf_images(pdf_path):
+        margin = max(8, min(image.shape[:2]) // 8)
+        image = cv2.copyMakeBorder(image, margin, margin, margin, margin,
+                                   cv2.BORDER_CONSTANT, value=(255, 255, 255))
+        detection = qr_processor.detect(image, **options)
+        if detection.codes:
+            info = dict(detection.to_dict(), page=page_number)
+            info['method'] = f"pdf_image:{detection.method}"
+            return detection.codes[0], info
+    
+    return None, None
+
+def extract_cufe_from_pdf_text(pdf_path):
+    """
+    Busca el CUFE en los enlaces (consulta de la DIAN) y en la capa de texto del PDF
+    
+    Solo se usa cuando no se pudo leer el QR: el CUFE no trae los demás datos
+    de la factura (número, fecha, NIT, valores) que contiene el QR.
+    
+    Returns:
+        (qr_data, detection_info) o (None, None) si no se encontró un CUFE
+    """
+    start = time.perf_counter()
+    for page_number, text, uris in iter_pdf_text(pdf_path):
+        method, cufe = 'pdf_link', next(filter(None, map(cufe_extractor.find_document_key, uris)), None)
+        if not cufe:
+            method, cufe = 'pdf_text', cufe_extractor.find_document_key(text)
+        if cufe:
+            return document_key_qr_data(cufe), {
+                'status': DetectionResult.STATUS_FOUND,
+                'codes_found': 1,
+                'method': method,
+                'attempts': 0,
+                'elapsed_ms': round((time.perf_counter() - start) * 1000, 1),
+                'page': page_number
+            }
+    return None, None
 
-def extract_qr_from_pdf(pdf_path):
-    """Extrae códigos QR de PDF usando pdf2image y procesador mejorado"""
+def extract_qr_from_pdf(pdf_path, detection_options=None):
+    """Extrae códigos QR de PDF (contenido embebido o páginas rasterizadas) con el procesador mejorado"""
     try:
-        # Convertir PDF a imágenes con mayor resolución (300 DPI para mejor calidad)
-        images = convert_from_path(pdf_path, dpi=300, fmt='PNG')
+        # Camino barato: imágenes embebidas del PDF; si falla, rasterizar páginas
+        content_first = app.config.get('QR_PDF_CONTENT_FIRST', True)
+        if content_first:
+            try:
+                qr_data, detection_info = extract_qr_from_pdf_images(pdf_path, detection_options)
+                if qr_data:
+                    return qr_data, None, detection_info
+            except Exception as e:
+                print(f"No se pudieron leer las imágenes del PDF, se rasteriza: {str(e)}")
         
-        for i, image in enumerate(images):
-            # Convertir PIL Image a formato OpenCV
-            opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            
+        low_dpi = app.config.get('QR_PDF_LOW_DPI', 0)
+        high_dpi = app.config.get('QR_PDF_DPI', 300)
+        two_pass = 0 < low_dpi < high_dpi
+        
+        detection_info = None
+        budget_exhausted = False
+        # Renderizar en escala de grises de a una página y detenerse en la primera con QR.
+        # Con dos pasadas, cada página se prueba primero a baja resolución (el QR de una
+        # factura electrónica es vectorial y suele leerse así) y solo las que fallan se
+        # vuelven a renderizar a resolución completa.
+        first_dpi = low_dpi if two_pass else high_dpi
+        for page_number, page in iter_pdf_pages(pdf_path, dpi=first_dpi, grayscale=True):
+            page_start = time.perf_counter()
             # Usar el procesador mejorado que prueba múltiples métodos
-            qr_codes = qr_processor.detect_qr_codes(opencv_image)
+            detection = qr_processor.detect(page, **(detection_options or {}))
+            detection_info = dict(detection.to_dict(), page=page_number, dpi=first_dpi)
+            
+            if not detection.codes and two_pass:
+                # Las dos resoluciones comparten el presupuesto por imagen de la página
+                options = remaining_budget(detection_options, detection.attempts, page_start)
+                page = None
+                if options is None:
+                    detection.status = DetectionResult.STATUS_BUDGET_EXHAUSTED
+                    detection_info['status'] = detection.status
+                else:
+                    page = render_pdf_page(pdf_path, page_number, dpi=high_dpi, grayscale=True)
+                if page is not None:
+                    attempts = detection.attempts
+                    detection = qr_processor.detect(page, **options)
+                    # Totales de la página (ambas resoluciones) frente a su presupuesto
+                    detection.attempts += attempts
+                    detection.elapsed_ms = (time.perf_counter() - page_start) * 1000
+                    detection.max_attempts = (detection_options or {}).get('max_attempts') or None
+                    detection.max_time_ms = (detection_options or {}).get('max_time_ms') or None
+                    detection_info = dict(detection.to_dict(), page=page_number, dpi=high_dpi)
             
-            if qr_codes:
+            budget_exhausted = budget_exhausted or detection.budget_exhausted
+            if detection.codes:
                 # Retornar el primer código QR encontrado
-                return qr_codes[0], None
+                return detection.codes[0], None, detection_info
         
-        return None, "No se encontraron códigos QR en el PDF"
+        # Sin QR legible: el CUFE de un enlace o de la capa de texto como último recurso
+        if content_first:
+            try:
+                qr_data, text_info = extract_cufe_from_pdf_text(pdf_path)
+                if qr_data:
+                    return qr_data, None, text_info
+            except Exception as e:
+                print(f"No se pudo leer el texto del PDF: {str(e)}")
+        
+        if detection_info is None:
+            return None, "El PDF no tiene páginas", None
+        if budget_exhausted:
+            detection_info['status'] = DetectionResult.STATUS_BUDGET_EXHAUSTED
+            return None, "Presupuesto de detección agotado sin encontrar códigos QR en el PDF", detection_info
+        return None, "No se encontraron códigos QR en el PDF", detection_info
         
     except Exception as e:
-        return None, f"Error al procesar PDF: {str(e)}"
+        return None, f"Error al procesar PDF: {str(e)}", None
 
-def extract_qr_from_heic(heic_path):
+def extract_qr_from_heic(heic_path, detection_options=None):
     """Extrae códigos QR de archivos HEIC usando pillow-heif y procesador mejorado"""
     try:
-        # Registrar plugins de HEIF
+        # Decodificar el HEIC conservando solo la luminancia (o tomar la decodificación anticipada)
         try:
-            register_heif_opener()
+            image = heif_decode_pool.decode(heic_path)
         except ImportError:
-            return None, "pillow-heif no está instalado"
-        
-        # Abrir archivo HEIC
-        image = Image.open(heic_path)
-        
-        # Convertir a RGB si es necesario
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Convertir a formato OpenCV
-        opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+            return None, "pillow-heif no está instalado", None
         
         # Usar el procesador mejorado que prueba múltiples métodos
-        qr_codes = qr_processor.detect_qr_codes(opencv_image)
+        detection = qr_processor.detect(image, **(detection_options or {}))
         
-        if qr_codes:
+        if detection.codes:
             # Retornar el primer código QR encontrado
-            return qr_codes[0], None
-        else:
-            return None, "No se encontraron códigos QR en el archivo HEIC"
+            return detection.codes[0], None, detection.to_dict()
+        
+        # HEIF con varias imágenes (ráfagas, pares estéreo): probar las demás
+        if count_frames(heic_path, 'image/heic') > 1:
+            qr_data, error, detection_info = extract_qr_from_frames(heic_path, detection_options, skip_primary=True,
+                                                                    file_type='image/heic')
+            if qr_data:
+                return qr_data, None, detection_info
+        
+        error = detection_error(detection, "No se encontraron códigos QR en el archivo HEIC")
+        return None, error, detection.to_dict()
             
     except Exception as e:
-        return None, f"Error al procesar archivo HEIC: {str(e)}"
+        return None, f"Error al procesar archivo HEIC: {str(e)}", None
+
+def ocr_fallback_requested(form=None):
+    """Indica si los archivos sin candidatos QR deben pasar a OCR ('ocrFallback' en la petición)"""
+    enabled = app.config.get('QR_OCR_FALLBACK', False)
+    if form is not None and form.get('ocrFallback'):
+        enabled = form.get('ocrFallback').lower() == 'true'
+    return enabled
+
+def extract_cufe_with_ocr(file_path, file_type):
+    """
+    Busca el CUFE impreso en el documento con OCR
+    
+    Returns:
+        (qr_data, detection_info) o (None, None) si el OCR no encontró un CUFE
+    """
+    start = time.perf_counter()
+    ocr_result = ocr_processor.process_file(file_path, file_type)
+    cufe = cufe_extractor.find_document_key(ocr_result.get('text', '')) if ocr_result.get('success') else None
+    if not cufe:
+        return None, None
+    return document_key_qr_data(cufe), {
+        'status': DetectionResult.STATUS_FOUND,
+        'codes_found': 1,
+        'method': 'ocr_text',
+        'attempts': 0,
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)
+    }
 
 def extract_cufe_from_qr(qr_data):
     """Extrae la clave de acceso/CUFE del código QR"""
@@ -130,7 +503,7 @@ def extract_cufe_from_qr(qr_data):
     except Exception as e:
         return qr_data  # Retornar el QR original si hay error
 
-def update_stats(success, file_type, processing_time=None, error=None):
+def update_stats(success, file_type, processing_time=None, error=None, detection_info=None):
     """Actualizar estadísticas globales de procesamiento"""
     STATS['total_processed'] += 1
     
@@ -149,6 +522,14 @@ def update_stats(success, file_type, processing_time=None, error=None):
     else:
         STATS['by_file_type'][file_type]['failed'] += 1
     
+    # Método que decodificó y presupuestos agotados
+    if detection_info:
+        method = detection_info.get('method')
+        if success and method:
+            STATS['by_method'][method] = STATS['by_method'].get(method, 0) + 1
+        if detection_info.get('status') == DetectionResult.STATUS_BUDGET_EXHAUSTED:
+            STATS['budget_exhausted'] += 1
+    
     # Tiempos de procesamiento
     if processing_time:
         STATS['processing_times'].append(processing_time)
@@ -156,16 +537,41 @@ def update_stats(success, file_type, processing_time=None, error=None):
         if len(STATS['processing_times']) > 100:
             STATS['processing_times'] = STATS['processing_times'][-100:]
 
-def process_file(file_path, file_type):
-    """Procesa un archivo y extrae códigos QR"""
+def process_file(file_path, file_type, detection_options=None, ocr_fallback=False, filename=None):
+    """
+    Procesa un archivo y extrae códigos QR
+    
+    Args:
+        file_path: Ruta al archivo o su contenido en memoria (bytes)
+        ocr_fallback: Si el pre-chequeo no encontró candidatos QR, buscar el CUFE con OCR
+        filename: Nombre original (para detectar el tipo por extensión si falta file_type)
+    """
+    if detection_options is None:
+        detection_options = get_detection_options()
+    
     start_time = time.time()
     try:
         qr_data = None
         error = None
+        detection_info = None
+        
+        # Un archivo ya procesado (mismo contenido) se responde desde la caché
+        cache_key = None
+        if result_cache is not None:
+            if is_path(file_path):
+                cache_key = result_cache.key_for_file(file_path)
+            else:
+                cache_key = result_cache.key_for_bytes(file_path)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                STATS['cache_hits'] += 1
+                update_stats(True, file_type or 'unknown', time.time() - start_time)
+                cached['cached'] = True
+                return cached
         
         # Si file_type está vacío, intentar detectar por extensión
         if not file_type or file_type == '':
-            filename_lower = file_path.lower()
+            filename_lower = (filename or (file_path if is_path(file_path) else '')).lower()
             if filename_lower.endswith(('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif')):
                 file_type = 'image/jpeg'  # Valor por defecto para imágenes
             elif filename_lower.endswith('.pdf'):
@@ -173,15 +579,32 @@ def process_file(file_path, file_type):
             elif filename_lower.endswith(('.heic', '.heif')):
                 file_type = 'image/heic'
         
+        # El tipo de archivo permite ordenar la cascada según el historial
+        detection_options = dict(detection_options, file_type=file_type)
+        # El respaldo OCR se activa con el estado 'no_candidate': requiere el pre-chequeo
+        # de patrones de posición aunque QR_PRESENCE_CHECK esté desactivado
+        if ocr_fallback:
+            detection_options['presence_check'] = True
+        
         if file_type in ['image/jpeg', 'image/jpg', 'image/png', 'image/bmp', 'image/tiff', 'image/tif']:
-            qr_data, error = extract_qr_from_image(file_path)
+            qr_data, error, detection_info = extract_qr_from_image(file_path, detection_options)
         elif file_type == 'application/pdf':
-            qr_data, error = extract_qr_from_pdf(file_path)
+            qr_data, error, detection_info = extract_qr_from_pdf(file_path, detection_options)
         elif file_type in ['image/heic', 'image/heif']:
-            qr_data, error = extract_qr_from_heic(file_path)
+            qr_data, error, detection_info = extract_qr_from_heic(file_path, detection_options)
         else:
             error = f"Tipo de archivo no soportado: {file_type or 'desconocido'}"
         
+        # Sin patrones de posición no hay QR que decodificar: leer el CUFE impreso
+        if (not qr_data and ocr_fallback and detection_info
+                and detection_info.get('status') == DetectionResult.STATUS_NO_CANDIDATE):
+            try:
+                ocr_data, ocr_info = extract_cufe_with_ocr(file_path, file_type)
+                if ocr_data:
+                    qr_data, error, detection_info = ocr_data, None, ocr_info
+            except Exception as e:
+                print(f"Error en el respaldo OCR: {str(e)}")
+        
         processing_time = time.time() - start_time
         
         if qr_data and not error:
@@ -192,21 +615,28 @@ def process_file(file_path, file_type):
             analysis = invoice_analyzer.analyze_qr_data(qr_data)
             
             # Actualizar estadísticas
-            update_stats(True, file_type, processing_time)
+            update_stats(True, file_type, processing_time, detection_info=detection_info)
             
-            return {
+            result = {
                 'success': True,
                 'qrData': qr_data,
                 'cufe': cufe,
-                'additionalInfo': analysis
+                'additionalInfo': analysis,
+                'detection': detection_info
             }
+            if cache_key is not None:
+                result_cache.set(cache_key, result)
+            return result
         else:
             # Actualizar estadísticas
-            update_stats(False, file_type, processing_time, error)
+            update_stats(False, file_type, processing_time, error, detection_info)
             
             return {
                 'success': False,
-                'error': error or "No se pudo extraer información del archivo"
+                'error': error or "No se pudo extraer información del archivo",
+                'budgetExhausted': bool(detection_info) and
+                    detection_info.get('status') == DetectionResult.STATUS_BUDGET_EXHAUSTED,
+                'detection': detection_info
             }
             
     except Exception as e:
@@ -220,140 +650,186 @@ def process_file(file_path, file_type):
             'debugInfo': traceback.format_exc()
         }
 
+def _remove_upload(file_path):
+    """Elimina un archivo temporal subido, sin propagar errores"""
+    if file_path and os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except Exception as cleanup_error:
+            print(f'Error al limpiar archivo temporal {file_path}: {str(cleanup_error)}')
+
 @app.route('/api/process-qr', methods=['POST'])
 def process_qr():
     try:
-        if 'files' not in request.files:
+        # El cuerpo se lee en streaming (sin request.files): cada archivo se procesa
+        # en cuanto termina de subir mientras el resto del lote sigue llegando
+        boundary = request.mimetype_params.get('boundary')
+        if request.mimetype != 'multipart/form-data' or not boundary:
             return jsonify({'error': 'No se encontraron archivos'}), 400
         
-        files = request.files.getlist('files')
-        if not files or files[0].filename == '':
-            return jsonify({'error': 'No se seleccionaron archivos'}), 400
-        
-        # Validar cantidad máxima de archivos
-        MAX_FILES = 500
-        if len(files) > MAX_FILES:
+        max_length = app.config.get('MAX_CONTENT_LENGTH')
+        if max_length and request.content_length and request.content_length > max_length:
             return jsonify({
-                'error': f'Se pueden procesar hasta {MAX_FILES} archivos a la vez. Has enviado {len(files)} archivos.'
-            }), 400
+                'error': f'La subida supera el tamaño máximo permitido ({format_file_size(max_length)})'
+            }), 413
+        
+        # Archivos por petición: al llegar uno más se deja de leer la subida
+        MAX_FILES = app.config.get('MAX_FILES', 500)
         
         results = []
-        total_files = len(files)
+        # Posición de cada resultado en la subida: se procesa por costo pero se responde en orden
+        result_indexes = []
+        total_files = 0
+        pending = []
         processed_count = 0
+        detection_options = None
         
-        # Procesar archivos con manejo robusto de errores
-        for index, file in enumerate(files, 1):
-            file_path = None
-            filename = None
-            try:
-                if file and allowed_file(file.filename):
-                    # Guardar archivo temporalmente
-                    filename = secure_filename(file.filename)
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    
-                    print(f'[{index}/{total_files}] Procesando archivo: {filename}')
-                    
-                    try:
-                        file.save(file_path)
-                    except Exception as save_error:
-                        print(f'Error al guardar archivo {filename}: {str(save_error)}')
+        pdf_dpi = app.config.get('QR_PDF_DPI', 300)
+        # Los archivos pequeños y medianos se decodifican desde memoria; solo los
+        # grandes pasan por el spool de la petición (bajo QR_SPOOL_DIR, idealmente un tmpfs)
+        spool = RequestSpool(SPOOL_ROOT)
+        receiver = None
+        try:
+            receiver = UploadReceiver(
+                request.stream, boundary, spool.path,
+                accept=allowed_file,
+                # Pre-escanear el costo (estructura del PDF o cabecera de la imagen) al recibir
+                prepare=lambda entry: entry.update(
+                    estimate=prescan_file(entry['source'], entry['content_type'], pdf_dpi)),
+                max_files=MAX_FILES,
+                max_bytes=max_length,
+                memory_max_bytes=app.config.get('QR_MEMORY_UPLOAD_MAX_MB', 8) * 1024 * 1024,
+                memory_budget_bytes=app.config.get('QR_MEMORY_UPLOAD_BUDGET_MB', 256) * 1024 * 1024
+            )
+            # Con QR_STREAMING_UPLOADS desactivado se recibe el lote completo antes de procesar
+            receiver.start(background=app.config.get('QR_STREAMING_UPLOADS', True))
+            
+            while True:
+                # 1. Incorporar los archivos ya recibidos (esperar si no queda ninguno)
+                for entry in receiver.next_entries(block=not pending):
+                    if 'error' in entry:
                         results.append({
-                            'fileName': filename,
+                            'fileName': entry['filename'],
                             'success': False,
-                            'error': f'Error al guardar archivo: {str(save_error)}',
-                            'fileType': file.content_type or 'application/octet-stream',
+                            'error': entry['error'],
+                            'fileType': entry['content_type'] or 'application/octet-stream',
                             'fileSize': 0,
                             'fileSizeFormatted': '0 B'
                         })
+                        result_indexes.append(entry['index'])
                         processed_count += 1
-                        continue
+                    else:
+                        pending.append(entry)
+                total_files = receiver.total_files
+                
+                if not pending:
+                    if receiver.finished:
+                        break
+                    continue
+                
+                # Las opciones deben preceder a los archivos en el formulario (o ir en la URL)
+                if detection_options is None:
+                    form = dict(request.args.to_dict(), **receiver.form)
+                    # Opciones de detección (modo 'first_hit' por defecto, 'exhaustive' opcional)
+                    detection_options = get_detection_options(form)
+                    ocr_fallback = ocr_fallback_requested(form)
+                
+                # 2. Procesar de menor a mayor costo entre los archivos recibidos: un PDF
+                #    de cientos de páginas no retrasa a las facturas pequeñas
+                pending = batch_planner.order(pending)
+                entry = pending.pop(0)
+                # Adelantar la decodificación de los próximos HEIC del lote
+                for upcoming in pending[:heif_decode_pool.max_pending]:
+                    if is_heif(upcoming['source'], upcoming['content_type']):
+                        heif_decode_pool.prefetch(upcoming['source'])
+                index = entry['index']
+                filename = entry['filename']
+                source = entry['source']
+                content_type = entry['content_type']
+                
+                print(f'[{index}/{total_files}] Procesando archivo: {filename} '
+                      f'({entry["estimate"]["pages"]} pág., {entry["estimate"]["megapixels"]} MP)')
+                
+                try:
+                    # Procesar archivo
+                    file_start = time.time()
+                    result = process_file(source, content_type, detection_options, ocr_fallback, filename)
+                    if not result.get('cached'):
+                        batch_planner.observe(entry['estimate'], time.time() - file_start)
+                    result['fileName'] = filename
+                    result['fileType'] = content_type or 'application/octet-stream'
+                    result['estimate'] = entry['estimate']
+                    # Tamaño contado al recibir (sin stat del archivo)
+                    result['fileSize'] = entry['size']
+                    result['fileSizeFormatted'] = format_file_size(entry['size'])
                     
-                    try:
-                        # Procesar archivo
-                        # Usar content_type o detectar por extensión
-                        content_type = file.content_type or ''
-                        result = process_file(file_path, content_type)
-                        result['fileName'] = filename
-                        result['fileType'] = content_type or 'application/octet-stream'
-                        
-                        # Obtener tamaño del archivo de forma segura
-                        try:
-                            result['fileSize'] = os.path.getsize(file_path) if os.path.exists(file_path) else 0
-                            result['fileSizeFormatted'] = format_file_size(result['fileSize'])
-                        except Exception as size_error:
-                            print(f'Error al obtener tamaño de archivo {filename}: {str(size_error)}')
-                            result['fileSize'] = 0
-                            result['fileSizeFormatted'] = '0 B'
-                        
-                        results.append(result)
-                        processed_count += 1
-                        print(f'[{index}/{total_files}] Archivo {filename} procesado exitosamente')
-                        
-                        # Liberar memoria periódicamente (cada 10 archivos)
-                        if processed_count % 10 == 0:
-                            import gc
-                            gc.collect()
-                            print(f'Memoria liberada después de procesar {processed_count} archivos')
-                        
-                    except Exception as process_error:
-                        import traceback
-                        error_trace = traceback.format_exc()
-                        print(f'Error al procesar archivo {filename}: {str(process_error)}')
-                        print(f'Traceback: {error_trace}')
-                        results.append({
-                            'fileName': filename,
-                            'success': False,
-                            'error': f'Error al procesar archivo: {str(process_error)}',
-                            'fileType': file.content_type or 'application/octet-stream',
-                            'fileSize': os.path.getsize(file_path) if file_path and os.path.exists(file_path) else 0,
-                            'fileSizeFormatted': format_file_size(os.path.getsize(file_path)) if file_path and os.path.exists(file_path) else '0 B',
-                            'debugInfo': error_trace
-                        })
-                        processed_count += 1
-                else:
-                    filename = file.filename if file else 'desconocido'
+                    results.append(result)
+                    result_indexes.append(index)
+                    processed_count += 1
+                    print(f'[{index}/{total_files}] Archivo {filename} procesado exitosamente, '
+                          f'restante estimado: {batch_planner.remaining_seconds(pending):.1f}s')
+                    
+                    # Liberar memoria periódicamente (cada 10 archivos)
+                    if processed_count % 10 == 0:
+                        import gc
+                        gc.collect()
+                        print(f'Memoria liberada después de procesar {processed_count} archivos')
+                    
+                except Exception as process_error:
+                    import traceback
+                    error_trace = traceback.format_exc()
+                    print(f'Error al procesar archivo {filename}: {str(process_error)}')
+                    print(f'Traceback: {error_trace}')
                     results.append({
                         'fileName': filename,
                         'success': False,
-                        'error': 'Tipo de archivo no permitido',
-                        'fileType': file.content_type if file else 'unknown',
-                        'fileSize': 0,
-                        'fileSizeFormatted': '0 B'
+                        'error': f'Error al procesar archivo: {str(process_error)}',
+                        'fileType': content_type or 'application/octet-stream',
+                        'fileSize': entry['size'],
+                        'fileSizeFormatted': format_file_size(entry['size']),
+                        'debugInfo': error_trace
                     })
+                    result_indexes.append(index)
                     processed_count += 1
-                    
-            except Exception as file_error:
-                import traceback
-                error_trace = traceback.format_exc()
-                print(f'Error inesperado procesando archivo {filename or "desconocido"}: {str(file_error)}')
-                print(f'Traceback: {error_trace}')
-                results.append({
-                    'fileName': filename or (file.filename if file else 'desconocido'),
-                    'success': False,
-                    'error': f'Error inesperado: {str(file_error)}',
-                    'fileType': file.content_type if file else 'unknown',
-                    'fileSize': 0,
-                    'fileSizeFormatted': '0 B',
-                    'debugInfo': error_trace
-                })
-                processed_count += 1
-            finally:
-                # Limpiar archivo temporal de forma segura
-                if file_path and os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                    except Exception as cleanup_error:
-                        print(f'Error al limpiar archivo temporal {file_path}: {str(cleanup_error)}')
+                finally:
+                    # Limpiar archivo temporal de forma segura (y su decodificación
+                    # anticipada si no se usó, por ejemplo en un acierto de caché)
+                    heif_decode_pool.discard(source)
+                    receiver.release(entry)
+                    _remove_upload(entry['file_path'])
+        finally:
+            # Archivos guardados que no llegaron a procesarse (interrupción) y los
+            # que el receptor aún no había entregado
+            for entry in pending:
+                heif_decode_pool.discard(entry['source'])
+                _remove_upload(entry['file_path'])
+            if receiver is not None:
+                receiver.close()
+            # El spool completo de la petición, incluido lo que haya quedado
+            spool.close()
+        
+        if total_files == 0:
+            return jsonify({'error': receiver.error or 'No se seleccionaron archivos'}), 400
         
+        # Responder en el orden de subida
+        results = [result for _, result in sorted(zip(result_indexes, results), key=lambda pair: pair[0])]
         print(f'Procesamiento completado: {len(results)}/{total_files} archivos procesados')
         
         # Retornar resultados con información de completitud
-        return jsonify({
+        response = {
             'results': results,
             'totalFiles': total_files,
             'processedFiles': len(results),
-            'completed': len(results) == total_files
-        })
+            'completed': len(results) == total_files and receiver.error is None and not receiver.too_many_files
+        }
+        if receiver.too_many_files:
+            # Se procesaron los primeros MAX_FILES; el resto de la subida no se leyó
+            response['warning'] = (f'Se pueden procesar hasta {MAX_FILES} archivos a la vez. Se retornan los '
+                                   f'primeros {MAX_FILES}; los demás no se procesaron.')
+        elif receiver.error:
+            # La subida se cortó: solo se procesaron los archivos recibidos completos
+            response['warning'] = f'{receiver.error}. Se retornan los archivos recibidos completos.'
+        return jsonify(response)
         
     except KeyboardInterrupt:
         # Si se interrumpe manualmente, retornar resultados parciales
@@ -425,7 +901,7 @@ def process_ocr():
             return jsonify({'error': 'No se seleccionaron archivos'}), 400
         
         # Validar cantidad máxima de archivos
-        MAX_FILES = 500
+        MAX_FILES = app.config.get('MAX_FILES', 500)
         if len(files) > MAX_FILES:
             return jsonify({
                 'error': f'Se pueden procesar hasta {MAX_FILES} archivos a la vez. Has enviado {len(files)} archivos.'
@@ -434,43 +910,45 @@ def process_ocr():
         results = []
         lang = request.form.get('lang', 'spa')  # Idioma para OCR, por defecto español
         
-        for file in files:
-            if file and allowed_file(file.filename):
-                # Guardar archivo temporalmente
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
-                
-                try:
-                    # Procesar archivo con OCR
-                    content_type = file.content_type or ''
-                    result = ocr_processor.process_file(file_path, content_type, lang)
-                    
-                    result['fileName'] = filename
-                    result['fileType'] = content_type or 'application/octet-stream'
-                    result['fileSize'] = os.path.getsize(file_path)
-                    result['fileSizeFormatted'] = format_file_size(result['fileSize'])
-                    
-                    results.append(result)
+        # Spool exclusivo de la petición: se elimina completo al terminar
+        with RequestSpool(SPOOL_ROOT) as spool:
+            for index, file in enumerate(files, 1):
+                if file and allowed_file(file.filename):
+                    # Guardar archivo temporalmente en el spool de la petición
+                    filename = secure_filename(file.filename)
+                    file_path = spool.file_path(index, filename)
+                    file.save(file_path)
                     
-                except Exception as e:
+                    try:
+                        # Procesar archivo con OCR
+                        content_type = file.content_type or ''
+                        result = ocr_processor.process_file(file_path, content_type, lang)
+                        
+                        result['fileName'] = filename
+                        result['fileType'] = content_type or 'application/octet-stream'
+                        result['fileSize'] = os.path.getsize(file_path)
+                        result['fileSizeFormatted'] = format_file_size(result['fileSize'])
+                        
+                        results.append(result)
+                        
+                    except Exception as e:
+                        results.append({
+                            'fileName': filename,
+                            'success': False,
+                            'error': f'Error al procesar archivo: {str(e)}',
+                            'fileType': content_type or 'application/octet-stream',
+                            'fileSize': os.path.getsize(file_path) if os.path.exists(file_path) else 0
+                        })
+                    finally:
+                        # Limpiar archivo temporal
+                        if os.path.exists(file_path):
+                            os.remove(file_path)
+                else:
                     results.append({
-                        'fileName': filename,
+                        'fileName': file.filename,
                         'success': False,
-                        'error': f'Error al procesar archivo: {str(e)}',
-                        'fileType': content_type or 'application/octet-stream',
-                        'fileSize': os.path.getsize(file_path) if os.path.exists(file_path) else 0
+                        'error': 'Tipo de archivo no permitido'
                     })
-                finally:
-                    # Limpiar archivo temporal
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-            else:
-                results.append({
-                    'fileName': file.filename,
-                    'success': False,
-                    'error': 'Tipo de archivo no permitido'
-                })
         
         return jsonify({'results': results})
         
@@ -516,8 +994,13 @@ def get_stats():
                     'failure_rate': round(failure_rate, 2)
                 },
                 'by_file_type': file_type_stats,
-                'by_method': {},  # No se usa en este servidor
+                'by_method': dict(sorted(STATS['by_method'].items(), key=lambda x: x[1], reverse=True)),
                 'common_errors': {},  # No se rastrea en este servidor
+                'budget_exhausted': STATS['budget_exhausted'],
+                'cache': dict(result_cache.stats(), served=STATS['cache_hits']) if result_cache else {},
+                'batch_planner': batch_planner.stats(),
+                'near_duplicates': duplicate_index.stats() if duplicate_index else {},
+                'decoders': DECODER_REGISTRY.stats(),
                 'performance': {
                     'avg_processing_time': round(avg_processing_time, 3),
                     'min_processing_time': round(min_processing_time, 3),
@@ -539,6 +1022,9 @@ def reset_stats():
         STATS['successful_detections'] = 0
         STATS['failed_detections'] = 0
         STATS['by_file_type'] = {}
+        STATS['by_method'] = {}
+        STATS['budget_exhausted'] = 0
+        STATS['cache_hits'] = 0
         STATS['processing_times'] = []
         
         return jsonify({
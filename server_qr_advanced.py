@@ -11,9 +11,14 @@ import io
 import traceback
 import numpy as np
 
+from image_decode import register_heif_support
+
 app = Flask(__name__)
 CORS(app)
 
+# Registrar el plugin HEIF una sola vez al iniciar el servidor
+HEIF_AVAILABLE = register_heif_support()
+
 # Configuración de archivos
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'bmp', 'tiff', 'tif', 'pdf', 'heic', 'heif'}
@@ -156,20 +161,21 @@ def extract_qr_advanced(image_path):
 def extract_qr_from_pdf_advanced(pdf_path):
     """Extracción avanzada de códigos QR de PDF"""
     try:
-        from pdf2image import convert_from_path
+        from pdf_render import get_page_count, iter_pdf_pages, page_to_pil
         from pyzbar import pyzbar
         
-        # Convertir PDF a imágenes con alta resolución
-        images = convert_from_path(pdf_path, dpi=300, fmt='PNG')
         debug_info = {
-            'pdf_pages': len(images),
+            'pdf_pages': get_page_count(pdf_path),
             'pages_processed': 0,
             'methods_tried': [],
             'qr_codes_found': 0
         }
         
-        for i, pil_image in enumerate(images):
-            debug_info['pages_processed'] = i + 1
+        # Renderizar con alta resolución de a una página: las siguientes a la del QR no se renderizan
+        for page_number, page in iter_pdf_pages(pdf_path, dpi=300):
+            i = page_number - 1
+            pil_image = page_to_pil(page)
+            debug_info['pages_processed'] = page_number
             
             # Preprocesar cada página
             processed_images = preprocess_image_advanced(pil_image)
@@ -202,11 +208,11 @@ def extract_qr_from_pdf_advanced(pdf_path):
 def extract_qr_from_heic_advanced(heic_path):
     """Extracción avanzada de códigos QR de archivos HEIC"""
     try:
-        from pillow_heif import register_heif_opener
         from pyzbar import pyzbar
         
-        # Registrar plugins de HEIF
-        register_heif_opener()
+        # El plugin HEIF se registra una sola vez al iniciar el servidor
+        if not HEIF_AVAILABLE:
+            raise ImportError('pillow-heif')
         
         # Abrir archivo HEIC
         image = Image.open(heic_path)
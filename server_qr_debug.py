@@ -10,9 +10,14 @@ from PIL import Image
 import io
 import traceback
 
+from image_decode import register_heif_support
+
 app = Flask(__name__)
 CORS(app)
 
+# Registrar el plugin HEIF una sola vez al iniciar el servidor
+HEIF_AVAILABLE = register_heif_support()
+
 # Configuración de archivos
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'bmp', 'tiff', 'tif', 'pdf', 'heic', 'heif'}
@@ -78,17 +83,18 @@ def extract_qr_from_image_pyzbar_debug(image_path):
 def extract_qr_from_pdf_debug(pdf_path):
     """Extrae códigos QR de PDF con información de debug"""
     try:
-        from pdf2image import convert_from_path
+        from pdf_render import get_page_count, iter_pdf_pages, page_to_pil
         from pyzbar import pyzbar
         
-        # Convertir PDF a imágenes
-        images = convert_from_path(pdf_path)
         debug_info = {
-            'pdf_pages': len(images),
+            'pdf_pages': get_page_count(pdf_path),
             'pages_processed': 0
         }
         
-        for i, pil_image in enumerate(images):
+        # Renderizar el PDF de a una página
+        for page_number, page in iter_pdf_pages(pdf_path, dpi=200):
+            i = page_number - 1
+            pil_image = page_to_pil(page)
             debug_info['pages_processed'] = i + 1
             
             # Intentar diferentes métodos
@@ -123,11 +129,11 @@ def extract_qr_from_pdf_debug(pdf_path):
 def extract_qr_from_heic_debug(heic_path):
     """Extrae códigos QR de archivos HEIC con información de debug"""
     try:
-        from pillow_heif import register_heif_opener
         from pyzbar import pyzbar
         
-        # Registrar plugins de HEIF
-        register_heif_opener()
+        # El plugin HEIF se registra una sola vez al iniciar el servidor
+        if not HEIF_AVAILABLE:
+            raise ImportError('pillow-heif')
         
         # Abrir archivo HEIC
         image = Image.open(heic_path)
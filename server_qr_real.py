@@ -12,9 +12,14 @@ import cv2
 import numpy as np
 from pyzbar import pyzbar
 
+from image_decode import register_heif_support
+
 app = Flask(__name__)
 CORS(app)
 
+# Registrar el plugin HEIF una sola vez al iniciar el servidor
+HEIF_AVAILABLE = register_heif_support()
+
 # Configuración de archivos
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'bmp', 'tiff', 'tif', 'pdf', 'heic', 'heif'}
@@ -56,20 +61,14 @@ def extract_qr_from_image_opencv(image_path):
 def extract_qr_from_pdf_pages(pdf_path):
     """Extrae códigos QR de PDF convirtiendo a imágenes"""
     try:
-        # Intentar importar pdf2image
+        # Intentar importar el renderizador de PDFs
         try:
-            from pdf2image import convert_from_path
+            from pdf_render import iter_pdf_pages
         except ImportError:
             return None, "pdf2image no está instalado"
         
-        # Convertir PDF a imágenes
-        images = convert_from_path(pdf_path)
-        
-        for i, pil_image in enumerate(images):
-            # Convertir PIL Image a formato OpenCV
-            opencv_image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-            gray = cv2.cvtColor(opencv_image, cv2.COLOR_BGR2GRAY)
-            
+        # Renderizar el PDF de a una página, directamente en escala de grises
+        for i, gray in iter_pdf_pages(pdf_path, dpi=200, grayscale=True):
             # Detectar códigos QR
             qr_codes = pyzbar.decode(gray)
             
@@ -85,11 +84,8 @@ def extract_qr_from_pdf_pages(pdf_path):
 def extract_qr_from_heic_real(heic_path):
     """Extrae códigos QR de archivos HEIC usando pillow-heif"""
     try:
-        # Registrar plugins de HEIF
-        try:
-            from pillow_heif import register_heif_opener
-            register_heif_opener()
-        except ImportError:
+        # El plugin HEIF se registra una sola vez al iniciar el servidor
+        if not HEIF_AVAILABLE:
             return None, "pillow-heif no está instalado"
         
         # Abrir archivo HEIC
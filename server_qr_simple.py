@@ -9,9 +9,14 @@ import base64
 from PIL import Image
 import io
 
+from image_decode import register_heif_support
+
 app = Flask(__name__)
 CORS(app)
 
+# Registrar el plugin HEIF una sola vez al iniciar el servidor
+HEIF_AVAILABLE = register_heif_support()
+
 # Configuración de archivos
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'bmp', 'tiff', 'tif', 'pdf', 'heic', 'heif'}
@@ -54,15 +59,13 @@ def extract_qr_from_image_pyzbar(image_path):
 def extract_qr_from_pdf_simple(pdf_path):
     """Extrae códigos QR de PDF usando pdf2image y Pyzbar"""
     try:
-        from pdf2image import convert_from_path
+        from pdf_render import iter_pdf_pages
         from pyzbar import pyzbar
         
-        # Convertir PDF a imágenes
-        images = convert_from_path(pdf_path)
-        
-        for i, pil_image in enumerate(images):
+        # Renderizar el PDF de a una página
+        for i, page in iter_pdf_pages(pdf_path, dpi=200, grayscale=True):
             # Detectar códigos QR en cada página
-            qr_codes = pyzbar.decode(pil_image)
+            qr_codes = pyzbar.decode(page)
             
             if qr_codes:
                 qr_data = qr_codes[0].data.decode('utf-8')
@@ -78,11 +81,11 @@ def extract_qr_from_pdf_simple(pdf_path):
 def extract_qr_from_heic_simple(heic_path):
     """Extrae códigos QR de archivos HEIC usando pillow-heif"""
     try:
-        from pillow_heif import register_heif_opener
         from pyzbar import pyzbar
         
-        # Registrar plugins de HEIF
-        register_heif_opener()
+        # El plugin HEIF se registra una sola vez al iniciar el servidor
+        if not HEIF_AVAILABLE:
+            raise ImportError('pillow-heif')
         
         # Abrir archivo HEIC
         image = Image.open(heic_path)
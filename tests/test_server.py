@@ -0,0 +1,205 @@
+"""
+Pruebas del servidor QR (presupuestos de detección y flujo de /api/process-qr)
+
+Requieren las dependencias de requirements.txt (incluida la librería zbar).
+Ejecutar desde la raíz del proyecto: python -m unittest discover -s tests
+"""
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+
+try:
+    import server
+    from utils import DetectionBudget, DetectionResult
+except ImportError as e:
+    raise unittest.SkipTest(f"Dependencias del servidor no disponibles: {e}")
+
+def detection(codes=(), attempts=1, ran_out=False):
+    """DetectionResult sintético con los intentos indicados"""
+    budget = DetectionBudget()
+    budget.attempts = attempts
+    budget.ran_out = ran_out
+    return DetectionResult(list(codes), budget)
+
+class FullResolutionBudgetTests(unittest.TestCase):
+    """Segunda pasada a resolución completa de fotos decodificadas reducidas"""
+    
+    def setUp(self):
+        handle, self.image_path = tempfile.mkstemp(suffix='.png')
+        os.close(handle)
+        cv2.imwrite(self.image_path, np.full((400, 400), 255, np.uint8))
+        self.calls = []
+        
+        def fake_detect(image, **options):
+            self.calls.append(options)
+            return detection(attempts=2)
+        
+        patches = [
+            mock.patch.object(server.qr_processor, 'detect', side_effect=fake_detect),
+            mock.patch.object(server.qr_processor, 'locate_qr_regions', return_value=[(0, 0, 50, 50), (50, 50, 50, 50)])
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+    
+    def tearDown(self):
+        os.remove(self.image_path)
+    
+    def test_unlimited_budget_runs_every_crop(self):
+        spent = detection(attempts=1)
+        result = server.detect_full_resolution(self.image_path, np.zeros((100, 100), np.uint8), 4,
+                                               {'mode': 'first_hit', 'max_attempts': 0, 'max_time_ms': 0},
+                                               spent=spent)
+        
+        self.assertEqual(len(self.calls), 2)
+        for options in self.calls:
+            self.assertFalse(options.get('max_attempts'))
+            self.assertFalse(options.get('max_time_ms'))
+        self.assertEqual(result.status, DetectionResult.STATUS_NOT_FOUND)
+        self.assertEqual(result.attempts, 5)
+    
+    def test_crops_share_the_remaining_attempts(self):
+        spent = detection(attempts=7)
+        result = server.detect_full_resolution(self.image_path, np.zeros((100, 100), np.uint8), 4,
+                                               {'mode': 'first_hit', 'max_attempts': 10, 'max_time_ms': 0},
+                                               spent=spent)
+        
+        self.assertEqual(self.calls[0]['max_attempts'], 3)
+        self.assertEqual(self.calls[1]['max_attempts'], 1)
+        self.assertEqual(result.attempts, 11)
+    
+    def test_exhausted_budget_skips_full_resolution(self):
+        spent = detection(attempts=10, ran_out=True)
+        result = server.detect_full_resolution(self.image_path, np.zeros((100, 100), np.uint8), 4,
+                                               {'mode': 'first_hit', 'max_attempts': 10, 'max_time_ms': 0},
+                                               spent=spent)
+        
+        self.assertEqual(self.calls, [])
+        self.assertEqual(result.status, DetectionResult.STATUS_BUDGET_EXHAUSTED)
+
+class PdfTwoPassBudgetTests(unittest.TestCase):
+    """Re-renderizado a resolución completa de páginas que fallan a baja resolución"""
+    
+    def setUp(self):
+        self.calls = []
+        
+        def fake_detect(image, **options):
+            self.calls.append(options)
+            return detection(attempts=6)
+        
+        page = np.full((200, 200), 255, np.uint8)
+        self.render = mock.patch.object(server, 'render_pdf_page', return_value=page).start()
+        patches = [
+            mock.patch.object(server.qr_processor, 'detect', side_effect=fake_detect),
+            mock.patch.object(server, 'iter_pdf_pages', return_value=iter([(1, page)])),
+            mock.patch.dict(server.app.config, {'QR_PDF_CONTENT_FIRST': False, 'QR_PDF_LOW_DPI': 150,
+                                                'QR_PDF_DPI': 300})
+        ]
+        for patch in patches:
+            patch.start()
+        self.addCleanup(mock.patch.stopall)
+    
+    def test_high_dpi_pass_uses_the_remaining_budget(self):
+        qr_data, error, info = server.extract_qr_from_pdf('factura.pdf', {'mode': 'first_hit', 'max_attempts': 10,
+                                                                          'max_time_ms': 0})
+        
+        self.assertIsNone(qr_data)
+        self.assertEqual(self.calls[1]['max_attempts'], 4)
+        self.assertEqual(info['attempts'], 12)
+        self.assertEqual(info['dpi'], 300)
+    
+    def test_spent_budget_skips_the_re_render(self):
+        qr_data, error, info = server.extract_qr_from_pdf('factura.pdf', {'mode': 'first_hit', 'max_attempts': 6,
+                                                                          'max_time_ms': 0})
+        
+        self.assertEqual(len(self.calls), 1)
+        self.render.assert_not_called()
+        self.assertEqual(info['status'], DetectionResult.STATUS_BUDGET_EXHAUSTED)
+
+class HitValidatorTests(unittest.TestCase):
+    """Solo un QR con CUFE de la DIAN cuenta como acierto en modo first_hit"""
+    
+    INVOICE_QR = 'NumFac: FE123\nCUFE: ' + '0f3a9c' * 16
+    OTHER_QR = 'https://example.com/promociones/temporada-2026'
+    
+    def test_long_payload_without_cufe_is_not_a_hit(self):
+        self.assertFalse(server.qr_processor.hit_validator(self.OTHER_QR))
+        self.assertTrue(server.qr_processor.hit_validator(self.INVOICE_QR))
+    
+    def test_validated_code_comes_first(self):
+        def fake_cascade(ctx, budget, qr_codes):
+            qr_codes.extend([self.OTHER_QR, self.INVOICE_QR])
+        
+        with mock.patch.object(server.qr_processor, '_run_cascade', side_effect=fake_cascade), \
+                mock.patch.object(server.qr_processor, 'duplicate_index', None):
+            result = server.qr_processor.detect(np.full((300, 300), 255, np.uint8), mode='exhaustive')
+        
+        self.assertEqual(result.codes[0], self.INVOICE_QR)
+
+class OcrFallbackEndToEndTests(unittest.TestCase):
+    """Respaldo OCR pedido por petición a través de /api/process-qr"""
+    
+    CUFE = '0f3a9c' * 16
+    
+    def setUp(self):
+        self.client = server.app.test_client()
+        patches = [
+            # Sin QR_PRESENCE_CHECK global: el pre-chequeo debe activarse por petición
+            mock.patch.object(server.qr_processor, 'presence_check', False),
+            mock.patch.object(server, 'result_cache', None),
+            mock.patch.object(server.ocr_processor, 'process_file',
+                              return_value={'success': True, 'text': f'Factura electrónica CUFE: {self.CUFE}'})
+        ]
+        self.ocr = patches[-1].start()
+        for patch in patches[:-1]:
+            patch.start()
+        for patch in patches:
+            self.addCleanup(patch.stop)
+    
+    def post_blank_page(self, **form):
+        page = cv2.imencode('.png', np.full((1100, 850), 255, np.uint8))[1].tobytes()
+        # Los campos de opciones van antes que los archivos (la subida se procesa en streaming)
+        data = dict(form, files=[(io.BytesIO(page), 'pagina.png', 'image/png')])
+        response = self.client.post('/api/process-qr', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()['results'][0]
+    
+    def test_ocr_fallback_reads_printed_cufe(self):
+        result = self.post_blank_page(ocrFallback='true')
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(result['detection']['method'], 'ocr_text')
+        self.assertIn(f'documentkey={self.CUFE}', result['qrData'])
+        self.ocr.assert_called_once()
+    
+    def test_without_ocr_fallback_no_ocr(self):
+        result = self.post_blank_page(ocrFallback='false')
+        
+        self.assertFalse(result['success'])
+        self.ocr.assert_not_called()
+
+class MaxFilesTests(unittest.TestCase):
+    """Lotes con más archivos que MAX_FILES en /api/process-qr"""
+    
+    def test_extra_files_are_reported_not_discarded(self):
+        page = cv2.imencode('.png', np.full((200, 200), 255, np.uint8))[1].tobytes()
+        files = [(io.BytesIO(page), f'pagina{index}.png', 'image/png') for index in range(3)]
+        
+        with mock.patch.dict(server.app.config, {'MAX_FILES': 2}), \
+                mock.patch.object(server, 'result_cache', None):
+            response = server.app.test_client().post('/api/process-qr', data={'files': files},
+                                                     content_type='multipart/form-data')
+        
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual([result['fileName'] for result in body['results']], ['pagina0.png', 'pagina1.png'])
+        self.assertFalse(body['completed'])
+        self.assertIn('2 archivos', body['warning'])
+
+if __name__ == '__main__':
+    unittest.main()
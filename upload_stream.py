@@ -0,0 +1,361 @@
+"""
+Recepción en streaming de subidas multipart
+
+El cuerpo de la petición se lee de a bloques (sin esperar a que Werkzeug
+analice el formulario completo) y cada archivo se entrega al llamador en
+cuanto termina de recibirse: la detección QR de los primeros archivos se
+solapa con la subida del resto del lote.
+
+Los archivos pequeños y medianos quedan en memoria y se decodifican desde
+sus bytes; solo los grandes se escriben en la carpeta de spool, que es
+exclusiva de cada petición (RequestSpool).
+"""
+import io
+import os
+import time
+import queue
+import shutil
+import logging
+import tempfile
+import threading
+
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from werkzeug.utils import secure_filename
+
+logger = logging.getLogger(__name__)
+
+# Prefijo de los subdirectorios de spool por petición: req-<pid>-<aleatorio>
+SPOOL_PREFIX = 'req-'
+
+class RequestSpool:
+    """
+    Carpeta de spool exclusiva de una petición
+    
+    Cada petición crea su propio subdirectorio (tempfile.mkdtemp) dentro de la
+    raíz de spool: lotes concurrentes, en el mismo worker o en otros, nunca
+    escriben ni borran los archivos de otro aunque los nombres coincidan.
+    close() elimina el subdirectorio completo.
+    """
+    
+    def __init__(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=f'{SPOOL_PREFIX}{os.getpid()}-', dir=root)
+    
+    def file_path(self, index, filename):
+        """Ruta para el archivo en la posición index del lote"""
+        return os.path.join(self.path, f'{index}_{filename}')
+    
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def sweep_spool(root, max_age_seconds):
+    """
+    Elimina los spools de peticiones que no terminaron (worker reiniciado por
+    timeout, señal o caída) y que por eso no se limpiaron
+    
+    Se eliminan los subdirectorios cuyo proceso dueño ya no existe en este
+    host o que superan max_age_seconds sin modificarse. Solo se tocan
+    subdirectorios con SPOOL_PREFIX: la raíz puede ser compartida (p. ej. /dev/shm).
+    
+    Returns:
+        Número de subdirectorios eliminados
+    """
+    if not os.path.isdir(root):
+        return 0
+    
+    now = time.time()
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.startswith(SPOOL_PREFIX) or not os.path.isdir(path) or os.path.islink(path):
+            continue
+        try:
+            age = now - os.path.getmtime(path)
+        except OSError:
+            continue
+        owner = name[len(SPOOL_PREFIX):].split('-', 1)[0]
+        orphaned = owner.isdigit() and int(owner) != os.getpid() and not _process_exists(int(owner))
+        if orphaned or age > max_age_seconds:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+def _process_exists(pid):
+    # En Windows os.kill terminaría el proceso: solo se usa la antigüedad
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Existe pero pertenece a otro usuario
+        return True
+    return True
+
+class UploadReceiver:
+    """
+    Lector de un cuerpo multipart que entrega cada archivo al terminar de recibirlo
+    
+    Cada archivo completo se publica como una entrada (dict) con 'index',
+    'filename', 'content_type', 'size', 'source' (el contenido en bytes, o la
+    ruta en el spool si supera memory_max_bytes) y 'file_path' (ruta en el
+    spool o None). Los rechazados o que no pudieron guardarse llevan 'error'
+    y no tienen archivo en disco. Los campos
+    de texto quedan en form (solo están disponibles los recibidos hasta el
+    momento: las opciones deben enviarse antes que los archivos).
+    """
+    
+    def __init__(self, stream, boundary, upload_folder, field_name='files', accept=None,
+                 prepare=None, max_files=None, max_bytes=None, memory_max_bytes=8 * 1024 * 1024,
+                 memory_budget_bytes=256 * 1024 * 1024, chunk_size=16 * 1024):
+        """
+        Args:
+            stream: Cuerpo de la petición (request.stream)
+            boundary: Separador multipart del Content-Type
+            upload_folder: Carpeta de spool de la petición para los archivos grandes
+                           (RequestSpool.path; idealmente en un tmpfs)
+            field_name: Campo del formulario que contiene los archivos
+            accept: Función nombre de archivo -> bool; los rechazados no se guardan
+            prepare: Función llamada con cada entrada guardada (p. ej. pre-escaneo de costo)
+            max_files: Archivos máximos por petición (None = sin límite)
+            max_bytes: Bytes máximos del cuerpo (None = sin límite)
+            memory_max_bytes: Archivos hasta este tamaño se conservan en memoria (0 = siempre a disco)
+            memory_budget_bytes: Total en memoria de archivos recibidos aún no liberados
+                                 (release); al superarlo los siguientes van al spool
+            chunk_size: Tamaño de cada lectura del cuerpo (wsgi.input bloquea hasta
+                        completarlo: un archivo se entrega como mucho chunk_size
+                        bytes después de terminar)
+        """
+        self.stream = stream
+        self.boundary = boundary.encode('latin-1') if isinstance(boundary, str) else boundary
+        self.upload_folder = upload_folder
+        self.field_name = field_name
+        self.accept = accept
+        self.prepare = prepare
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_budget_bytes = memory_budget_bytes
+        self._memory_bytes = 0
+        self.chunk_size = chunk_size
+        self.form = {}
+        self.total_files = 0
+        self.too_many_files = False
+        # Mensaje si la lectura terminó antes del final del cuerpo (desconexión, tamaño)
+        self.error = None
+        self._queue = queue.Queue()
+        self._done = threading.Event()
+        self._stop = threading.Event()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def start(self, background=True):
+        """
+        Comienza a leer el cuerpo
+        
+        Args:
+            background: Leer en un hilo aparte (los archivos se procesan mientras
+                        llegan); con False se lee todo el cuerpo antes de retornar
+        """
+        if background:
+            self._thread = threading.Thread(target=self._run, name='upload-receiver', daemon=True)
+            self._thread.start()
+        else:
+            self._run()
+    
+    @property
+    def finished(self):
+        """True si se leyó todo el cuerpo y no quedan entradas por consumir"""
+        return self._done.is_set() and self._queue.empty()
+    
+    def next_entries(self, block=True):
+        """
+        Entradas recibidas desde la llamada anterior
+        
+        Args:
+            block: Esperar hasta que llegue al menos una entrada o termine el cuerpo
+        
+        Returns:
+            Lista de entradas (vacía si no hay nuevas o si la lectura terminó)
+        """
+        entries = []
+        if block:
+            while not entries:
+                try:
+                    entries.append(self._queue.get(timeout=0.1))
+                except queue.Empty:
+                    if self._done.is_set() and self._queue.empty():
+                        return []
+        while True:
+            try:
+                entries.append(self._queue.get_nowait())
+            except queue.Empty:
+                return entries
+    
+    def release(self, entry):
+        """Indica que el contenido en memoria de una entrada ya no se usa"""
+        if entry.get('file_path') is None and 'source' in entry:
+            with self._lock:
+                self._memory_bytes -= entry['size']
+    
+    def close(self, timeout=5.0):
+        """Detiene la lectura y elimina los archivos recibidos que no se consumieron"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            self._closed = True
+        for entry in self.next_entries(block=False):
+            self._remove(entry.get('file_path'))
+    
+    def _emit(self, entry):
+        with self._lock:
+            if not self._closed:
+                self._queue.put(entry)
+                return
+        # El llamador ya no consume entradas: no dejar el archivo huérfano
+        self._remove(entry.get('file_path'))
+    
+    def _run(self):
+        decoder = MultipartDecoder(self.boundary, max_form_memory_size=1024 * 1024)
+        received = 0
+        # Parte en curso: (entrada o nombre de campo, archivo abierto o buffer del campo)
+        part = None
+        try:
+            while not self._stop.is_set():
+                chunk = self.stream.read(self.chunk_size)
+                received += len(chunk)
+                if self.max_bytes and received > self.max_bytes:
+                    self.error = 'La subida supera el tamaño máximo permitido'
+                    break
+                decoder.receive_data(chunk or None)
+                
+                event = decoder.next_event()
+                while not isinstance(event, (NeedData, Epilogue)):
+                    part = self._handle(event, part)
+                    event = decoder.next_event()
+                    if self._stop.is_set():
+                        break
+                
+                if isinstance(event, Epilogue):
+                    break
+                if not chunk:
+                    self.error = 'La subida terminó de forma incompleta'
+                    break
+        except ClientDisconnected:
+            self.error = 'La conexión se cerró antes de terminar la subida'
+        except Exception as e:
+            logger.warning(f"Error al recibir la subida: {e}")
+            self.error = f'Error al recibir la subida: {str(e)}'
+        finally:
+            # Archivo a medio recibir (interrupción o error)
+            if part is not None and isinstance(part[0], dict) and part[1] is not None:
+                part[1].close()
+                self._remove(part[0].get('file_path'))
+            self._done.set()
+    
+    def _handle(self, event, part):
+        """Procesa un evento del decodificador y retorna la parte en curso"""
+        if isinstance(event, Field):
+            return event.name, []
+        
+        if isinstance(event, File):
+            if event.name != self.field_name or not event.filename:
+                # Otro campo de archivo o selector vacío: se descarta su contenido
+                return None
+            if self.max_files is not None and self.total_files >= self.max_files:
+                self.too_many_files = True
+                self._stop.set()
+                return None
+            self.total_files += 1
+            entry = {
+                'index': self.total_files,
+                'filename': secure_filename(event.filename),
+                'content_type': event.headers.get('Content-Type', ''),
+                'size': 0,
+                'file_path': None
+            }
+            if self.accept is not None and not self.accept(event.filename):
+                entry['error'] = 'Tipo de archivo no permitido'
+                return entry, None
+            if self.memory_max_bytes:
+                return entry, io.BytesIO()
+            try:
+                return entry, self._spool(entry, b'')
+            except OSError as e:
+                entry['file_path'] = None
+                entry['error'] = f'Error al guardar archivo: {str(e)}'
+                return entry, None
+        
+        if isinstance(event, Data) and part is not None:
+            target, sink = part
+            if isinstance(sink, list):
+                sink.append(event.data)
+                if not event.more_data:
+                    self.form[target] = b''.join(sink).decode('utf-8', errors='replace')
+                    return None
+                return part
+            
+            if sink is not None and event.data:
+                try:
+                    sink.write(event.data)
+                    target['size'] += len(event.data)
+                    # Demasiado grande para memoria (o el lote ya ocupa el presupuesto):
+                    # continuar en el spool
+                    if isinstance(sink, io.BytesIO) and (
+                            target['size'] > self.memory_max_bytes or
+                            self._memory_bytes + target['size'] > self.memory_budget_bytes):
+                        sink = self._spool(target, sink.getbuffer())
+                        part = target, sink
+                except OSError as e:
+                    sink.close()
+                    self._remove(target['file_path'])
+                    target['file_path'] = None
+                    target['error'] = f'Error al guardar archivo: {str(e)}'
+                    sink = None
+                    part = target, None
+            if event.more_data:
+                return part
+            
+            if sink is not None:
+                if isinstance(sink, io.BytesIO):
+                    target['source'] = sink.getvalue()
+                    with self._lock:
+                        self._memory_bytes += target['size']
+                else:
+                    target['source'] = target['file_path']
+                sink.close()
+                if self.prepare is not None:
+                    try:
+                        self.prepare(target)
+                    except Exception as e:
+                        logger.debug(f"Error al preparar {target['filename']}: {e}")
+            self._emit(target)
+            return None
+        
+        return part
+    
+    def _spool(self, entry, data):
+        """Abre el archivo de spool de una entrada y escribe lo ya recibido"""
+        # Prefijo de posición: puede haber nombres repetidos en el lote
+        entry['file_path'] = os.path.join(self.upload_folder, f"{entry['index']}_{entry['filename']}")
+        sink = open(entry['file_path'], 'wb')
+        sink.write(data)
+        return sink
+    
+    @staticmethod
+    def _remove(path):
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -2,20 +2,781 @@
 Utilidades para el procesamiento de códigos QR y facturas
 """
 
+import os
 import re
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import cv2
 import numpy as np
-from typing import List, Tuple, Optional, Dict, Any
+from typing import List, Tuple, Optional, Dict, Any, Union, Callable, Sequence
 import logging
 
+try:
+    import fcntl
+except ImportError:
+    # Windows: el archivo de estado se combina sin bloqueo entre procesos
+    fcntl = None
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class DetectionBudget:
+    """Presupuesto de detección por imagen (intentos y/o milisegundos)"""
+    
+    def __init__(self, first_hit: bool = False, max_attempts: Optional[int] = None,
+                 max_time_ms: Optional[float] = None, input_class: Optional[str] = None,
+                 hit_validator: Optional[Callable[[str], bool]] = None):
+        """
+        Args:
+            first_hit: Detener la cascada en cuanto se decodifique un código
+            max_attempts: Máximo de decodificaciones por imagen (None o 0 = sin límite)
+            max_time_ms: Máximo de milisegundos por imagen (None o 0 = sin límite)
+            input_class: Clase de entrada para el ordenamiento adaptativo (opcional)
+            hit_validator: Función que decide si un código decodificado cuenta
+                           como acierto (None = cualquier código)
+        """
+        self.first_hit = first_hit
+        self.hit_validator = hit_validator
+        self.max_attempts = max_attempts if max_attempts and max_attempts > 0 else None
+        self.max_time_ms = max_time_ms if max_time_ms and max_time_ms > 0 else None
+        self.input_class = input_class
+        self.attempts = 0
+        self.found = False
+        # True si la búsqueda se cortó por falta de presupuesto
+        self.ran_out = False
+        self.winner: Optional[str] = None
+        # Resultados por método/variante: (nombre, éxito, milisegundos)
+        self.outcomes: List[Tuple[str, bool, float]] = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+    
+    @property
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+    
+    @property
+    def remaining_ms(self) -> Optional[float]:
+        """Milisegundos restantes del presupuesto de tiempo (None = sin límite)"""
+        if self.max_time_ms is None:
+            return None
+        return max(self.max_time_ms - self.elapsed_ms, 0.0)
+    
+    @property
+    def exhausted(self) -> bool:
+        """True si se agotaron los intentos o el tiempo disponible"""
+        if self.max_attempts is not None and self.attempts >= self.max_attempts:
+            return True
+        if self.max_time_ms is not None and self.elapsed_ms >= self.max_time_ms:
+            return True
+        return False
+    
+    def should_stop(self) -> bool:
+        """True si no se deben lanzar más intentos de decodificación"""
+        if self.first_hit and self.found:
+            return True
+        if self.exhausted:
+            self.ran_out = True
+            return True
+        return False
+    
+    def try_attempt(self) -> bool:
+        """Registra un intento si queda presupuesto; False si hay que detenerse"""
+        with self._lock:
+            if self.should_stop():
+                return False
+            self.attempts += 1
+            return True
+    
+    def mark_found(self, codes: List[str]):
+        """Marca el acierto si algún código pasa la validación"""
+        if self.hit_validator is None or any(self.hit_validator(code) for code in codes):
+            self.found = True
+    
+    def record(self, arm: str, success: bool, elapsed_ms: float):
+        """Registra el resultado de un método o variante de la cascada"""
+        with self._lock:
+            self.outcomes.append((arm, success, elapsed_ms))
+            if success and self.winner is None:
+                self.winner = arm
+
+class DetectionResult:
+    """Resultado estructurado de la detección QR sobre una imagen"""
+    
+    STATUS_FOUND = 'found'
+    STATUS_NOT_FOUND = 'not_found'
+    STATUS_BUDGET_EXHAUSTED = 'budget_exhausted'
+    # El pre-chequeo no encontró patrones de posición: la cascada se omitió
+    STATUS_NO_CANDIDATE = 'no_candidate'
+    
+    def __init__(self, codes: List[str], budget: DetectionBudget):
+        self.codes = codes
+        self.attempts = budget.attempts
+        self.elapsed_ms = budget.elapsed_ms
+        self.method = budget.winner
+        # Rectángulo relativo (x, y, ancho, alto) donde se encontró el QR, si se conoce
+        self.region: Optional[Tuple[float, float, float, float]] = None
+        self.max_attempts = budget.max_attempts
+        self.max_time_ms = budget.max_time_ms
+        if codes:
+            self.status = self.STATUS_FOUND
+        elif budget.ran_out:
+            self.status = self.STATUS_BUDGET_EXHAUSTED
+        else:
+            self.status = self.STATUS_NOT_FOUND
+    
+    @property
+    def budget_exhausted(self) -> bool:
+        return self.status == self.STATUS_BUDGET_EXHAUSTED
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'status': self.status,
+            'codes_found': len(self.codes),
+            'method': self.method,
+            'region': list(self.region) if self.region else None,
+            'attempts': self.attempts,
+            'elapsed_ms': round(self.elapsed_ms, 1),
+            'max_attempts': self.max_attempts,
+            'max_time_ms': self.max_time_ms
+        }
+
+class MethodScheduler:
+    """
+    Ordenamiento adaptativo de la cascada de detección
+    
+    Registra qué método/variante decodificó cada archivo, agrupado por clase
+    de entrada (tipo de archivo y tamaño de imagen), y reordena la cascada
+    como un bandido multibrazo (muestreo de Thompson): primero va la variante
+    con mayor probabilidad de éxito por milisegundo. Las estadísticas se
+    persisten en JSON y sirven como prior para los siguientes procesos; los
+    workers que comparten el archivo suman sus actualizaciones al guardar.
+    """
+    
+    # Milisegundos de costo supuesto por posición para brazos sin historial
+    PRIOR_COST_STEP_MS = 10.0
+    # Intentos a partir de los cuales se usa el historial de un brazo; los brazos
+    # con menos conservan su posición por defecto (en frío, el orden por defecto)
+    MIN_TRIALS = 10
+    
+    def __init__(self, state_path: Optional[str] = None, save_every: int = 20,
+                 max_trials: int = 500):
+        """
+        Args:
+            state_path: Archivo JSON donde se persiste el prior (None = solo en memoria)
+            save_every: Número de actualizaciones entre escrituras a disco
+            max_trials: Intentos por brazo a partir de los cuales se decae el historial
+        """
+        self.state_path = state_path
+        self.save_every = save_every
+        self.max_trials = max_trials
+        self._lock = threading.Lock()
+        self._pending_updates = 0
+        # {clase: {brazo: {'n': intentos, 's': éxitos, 'ms': milisegundos acumulados}}}
+        self.stats: Dict[str, Dict[str, Dict[str, float]]] = self._load()
+        # Actualizaciones de este proceso aún no guardadas (mismo formato, sin decaer)
+        self._unsaved: Dict[str, Dict[str, Dict[str, float]]] = {}
+    
+    @staticmethod
+    def classify(file_type: Optional[str], shape: Sequence[int]) -> str:
+        """
+        Clase de entrada a partir del tipo de archivo y el tamaño de la imagen
+        
+        Args:
+            file_type: Tipo MIME del archivo
+            shape: Dimensiones de la imagen (alto, ancho, ...)
+            
+        Returns:
+            Clave de clase, por ejemplo 'pdf:large' o 'image:medium'
+        """
+        file_type = (file_type or '').lower()
+        if 'pdf' in file_type:
+            family = 'pdf'
+        elif 'heic' in file_type or 'heif' in file_type:
+            family = 'heic'
+        else:
+            family = 'image'
+        
+        megapixels = shape[0] * shape[1] / 1_000_000
+        if megapixels < 2:
+            size = 'small'
+        elif megapixels < 8:
+            size = 'medium'
+        else:
+            size = 'large'
+        
+        return f"{family}:{size}"
+    
+    def order(self, input_class: str, items: Sequence[Any],
+              name_fn: Callable[[Any], str] = str) -> List[Any]:
+        """
+        Ordena los elementos de la cascada para una clase de entrada
+        
+        Args:
+            input_class: Clase de entrada (ver classify)
+            items: Métodos o variantes en su orden por defecto
+            name_fn: Función que obtiene el nombre de brazo de cada elemento
+            
+        Returns:
+            Lista reordenada (mayor éxito esperado por milisegundo primero)
+        """
+        with self._lock:
+            arms = self.stats.get(input_class, {})
+            scores = []
+            for index, item in enumerate(items):
+                arm = arms.get(name_fn(item), {})
+                if arm.get('n', 0) < self.MIN_TRIALS:
+                    arm = {}
+                trials = arm.get('n', 0)
+                successes = arm.get('s', 0)
+                prior_cost = self.PRIOR_COST_STEP_MS * (index + 1)
+                cost = (prior_cost + arm.get('ms', 0.0)) / (1 + trials)
+                # Sin historial suficiente: la media del prior, sin ruido de muestreo
+                theta = random.betavariate(1 + successes, 1 + trials - successes) if trials else 0.5
+                scores.append((theta / max(cost, 0.1), -index))
+        
+        ranked = sorted(zip(scores, items), key=lambda pair: pair[0], reverse=True)
+        return [item for _, item in ranked]
+    
+    def update(self, input_class: str, outcomes: Sequence[Tuple[str, bool, float]]):
+        """
+        Incorpora los resultados de una imagen al historial
+        
+        Args:
+            input_class: Clase de entrada (ver classify)
+            outcomes: Lista de (brazo, éxito, milisegundos)
+        """
+        if not outcomes:
+            return
+        
+        delta = {input_class: {}}
+        for name, success, elapsed_ms in outcomes:
+            arm = delta[input_class].setdefault(name, {'n': 0, 's': 0, 'ms': 0.0})
+            arm['n'] += 1
+            arm['s'] += 1 if success else 0
+            arm['ms'] += elapsed_ms
+        
+        with self._lock:
+            self._add(self.stats, delta, decay=True)
+            self._add(self._unsaved, delta)
+            self._pending_updates += 1
+            should_save = self._pending_updates >= self.save_every
+        
+        if should_save:
+            self.save()
+    
+    def _add(self, target: Dict[str, Dict[str, Dict[str, float]]],
+             source: Dict[str, Dict[str, Dict[str, float]]], decay: bool = False):
+        """Suma los contadores de source en target (decay: aplicar el decaimiento del historial)"""
+        for input_class, source_arms in source.items():
+            arms = target.setdefault(input_class, {})
+            for name, counts in source_arms.items():
+                arm = arms.setdefault(name, {'n': 0, 's': 0, 'ms': 0.0})
+                for key in ('n', 's', 'ms'):
+                    arm[key] += counts.get(key, 0)
+                # Decaer el historial para adaptarse a cambios en la mezcla de documentos
+                if decay and arm['n'] > self.max_trials:
+                    for key in arm:
+                        arm[key] /= 2
+    
+    def save(self):
+        """
+        Persiste el historial en disco (escritura atómica)
+        
+        El archivo es compartido por los workers: las actualizaciones de este
+        proceso desde la última escritura se suman al estado que haya en disco
+        (con bloqueo de archivo donde existe fcntl), y el resultado pasa a ser
+        el historial local, que así incorpora lo aprendido por los demás.
+        """
+        if not self.state_path:
+            return
+        
+        with self._lock:
+            unsaved = self._unsaved
+            self._unsaved = {}
+            self._pending_updates = 0
+        
+        try:
+            directory = os.path.dirname(self.state_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._state_file_lock():
+                merged = self._load()
+                self._add(merged, unsaved, decay=True)
+                tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(merged, f)
+                os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            logger.warning(f"No se pudo guardar el estado del planificador: {e}")
+            # Conservar las actualizaciones para la próxima escritura
+            with self._lock:
+                self._add(self._unsaved, unsaved)
+            return
+        
+        with self._lock:
+            # Lo registrado mientras se escribía queda pendiente para la próxima escritura
+            self._add(merged, self._unsaved, decay=True)
+            self.stats = merged
+    
+    @contextmanager
+    def _state_file_lock(self):
+        """Bloqueo exclusivo entre procesos durante la lectura-combinación-escritura"""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.state_path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def _load(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"No se pudo cargar el estado del planificador: {e}")
+            return {}
+
+class ImageContext:
+    """
+    Contexto por imagen con derivados calculados de forma perezosa
+    
+    Cada derivado (gris, invertido, CLAHE, ecualizado, suavizados y niveles
+    de pirámide) se calcula como máximo una vez y se comparte entre todos los
+    métodos de detección como vista de solo lectura.
+    """
+    
+    def __init__(self, image: np.ndarray, arm_prefix: str = '',
+                 region: Optional[Tuple[float, float, float, float]] = None):
+        """
+        Args:
+            image: Imagen (BGR o escala de grises)
+            arm_prefix: Prefijo de los nombres de método/variante registrados
+                        para esta imagen (por ejemplo 'crop:' para recortes)
+            region: Para recortes, rectángulo de origen relativo a la imagen
+                    completa (x, y, ancho, alto como fracciones)
+        """
+        self.image = self._readonly(image.view())
+        self.arm_prefix = arm_prefix
+        self.region = region
+        # Regiones candidatas (x, y, ancho, alto) calculadas una vez por QRProcessor
+        self.candidate_regions: Optional[List[Tuple[int, int, int, int]]] = None
+        self._skew: Optional[float] = None
+        self._cache: Dict[Any, np.ndarray] = {}
+        # Un candado por derivado: variantes en paralelo no recalculan lo mismo
+        self._locks: Dict[Any, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+    
+    @staticmethod
+    def _readonly(array: np.ndarray) -> np.ndarray:
+        array.flags.writeable = False
+        return array
+    
+    def _memo(self, key: Any, factory) -> np.ndarray:
+        """Retorna el derivado en caché o lo calcula una única vez"""
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+        with self._locks_guard:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            cached = self._cache.get(key)
+            if cached is None:
+                cached = self._readonly(factory())
+                self._cache[key] = cached
+        return cached
+    
+    @property
+    def is_color(self) -> bool:
+        return len(self.image.shape) == 3
+    
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.image.shape[:2]
+    
+    @property
+    def gray(self) -> np.ndarray:
+        if not self.is_color:
+            return self.image
+        return self._memo('gray', lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY))
+    
+    @property
+    def inverted(self) -> np.ndarray:
+        return self._memo('inverted', lambda: cv2.bitwise_not(self.gray))
+    
+    @property
+    def clahe(self) -> np.ndarray:
+        """Contraste mejorado con CLAHE (Contrast Limited Adaptive Histogram Equalization)"""
+        def build():
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+            return clahe.apply(self.gray)
+        return self._memo('clahe', build)
+    
+    @property
+    def equalized(self) -> np.ndarray:
+        return self._memo('equalized', lambda: cv2.equalizeHist(self.gray))
+    
+    @property
+    def adaptive_threshold(self) -> np.ndarray:
+        return self._memo('adaptive_threshold', lambda: cv2.adaptiveThreshold(
+            self.gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2
+        ))
+    
+    def gaussian_blur(self, ksize: int) -> np.ndarray:
+        return self._memo(('gaussian_blur', ksize),
+                          lambda: cv2.GaussianBlur(self.gray, (ksize, ksize), 0))
+    
+    def median_blur(self, ksize: int) -> np.ndarray:
+        return self._memo(('median_blur', ksize), lambda: cv2.medianBlur(self.gray, ksize))
+    
+    def pyramid_level(self, level: int) -> np.ndarray:
+        """
+        Nivel de la pirámide gaussiana en escala de grises
+        
+        Args:
+            level: 0 = resolución original, cada nivel reduce a la mitad
+        """
+        if level <= 0:
+            return self.gray
+        return self._memo(('pyramid', level), lambda: cv2.pyrDown(self.pyramid_level(level - 1)))
+    
+    def perceptual_hash(self) -> int:
+        """
+        Hash perceptual (pHash de 64 bits) calculado sobre una miniatura
+        
+        Imágenes casi iguales (re-escaneos, JPEG re-guardados) difieren en
+        pocos bits, a diferencia de un hash de bytes.
+        """
+        small = self.pyramid_level(self.level_for_side(256))
+        thumbnail = cv2.resize(small, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+        low_freq = cv2.dct(thumbnail)[:8, :8].flatten()
+        # El componente DC no aporta información de estructura
+        bits = low_freq > np.median(low_freq[1:])
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+    
+    def skew_angle(self) -> float:
+        """
+        Inclinación dominante en grados, en (-45, 45], estimada sobre una miniatura
+        
+        Se toma la mediana (ponderada por longitud) del ángulo de los segmentos
+        rectos largos: renglones de texto, bordes de tablas y del propio QR.
+        Retorna 0.0 si no hay segmentos suficientes para estimarla.
+        """
+        if self._skew is None:
+            small = self.pyramid_level(self.level_for_side(800))
+            min_length = max(small.shape) // 8
+            edges = cv2.Canny(small, 50, 150)
+            lines = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=80,
+                                    minLineLength=min_length, maxLineGap=5)
+            angle = 0.0
+            if lines is not None and len(lines) >= 5:
+                x1, y1, x2, y2 = lines.reshape(-1, 4).astype(np.float64).T
+                angles = (np.degrees(np.arctan2(y2 - y1, x2 - x1)) + 45) % 90 - 45
+                lengths = np.hypot(x2 - x1, y2 - y1)
+                order = np.argsort(angles)
+                cumulative = np.cumsum(lengths[order])
+                angle = float(angles[order][np.searchsorted(cumulative, cumulative[-1] / 2)])
+            self._skew = angle
+        return self._skew
+    
+    def level_for_side(self, max_side: int) -> int:
+        """Primer nivel de pirámide cuyo lado mayor no supera max_side"""
+        h, w = self.shape
+        level = 0
+        while max(h, w) / (2 ** level) > max_side:
+            level += 1
+        return level
+
+def _decode_bytes(data: bytes) -> str:
+    """Decodifica el contenido de un QR en UTF-8 (o latin-1 como alternativa)"""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+class DecoderBackend:
+    """
+    Backend de decodificación QR con métricas de uso
+    
+    Cada backend reporta disponibilidad, latencia por llamada y tasa de
+    aciertos, de modo que se puedan comparar y ordenar sin tocar la cascada.
+    """
+    
+    name = ''
+    
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.total_ms = 0.0
+        self._available: Optional[bool] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    
+    def is_available(self) -> bool:
+        """True si las dependencias del backend están instaladas (se evalúa una vez)"""
+        if self._available is None:
+            try:
+                self._load()
+                self._available = True
+            except Exception as e:
+                logger.info(f"Decodificador '{self.name}' no disponible: {e}")
+                self._available = False
+        return self._available
+    
+    def decode(self, image: np.ndarray) -> List[str]:
+        """Decodifica la imagen registrando latencia y aciertos"""
+        start = time.perf_counter()
+        try:
+            codes = [code for code in self._decode(image) if code]
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.calls += 1
+                self.total_ms += elapsed_ms
+        if codes:
+            with self._lock:
+                self.hits += 1
+        return codes
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'available': bool(self._available),
+                'calls': self.calls,
+                'hits': self.hits,
+                'hit_rate': round(self.hits / self.calls * 100, 2) if self.calls else 0,
+                'avg_ms': round(self.total_ms / self.calls, 3) if self.calls else 0
+            }
+    
+    def _load(self):
+        """Importa las dependencias; lanza una excepción si no están disponibles"""
+        raise NotImplementedError
+    
+    def _decode(self, image: np.ndarray) -> List[str]:
+        raise NotImplementedError
+    
+    def _thread_detector(self, factory):
+        """Detector reutilizado por hilo (los detectores de OpenCV no son thread-safe)"""
+        detector = getattr(self._local, 'detector', None)
+        if detector is None:
+            detector = factory()
+            self._local.detector = detector
+        return detector
+
+class PyzbarBackend(DecoderBackend):
+    """Pyzbar restringido a la simbología QR"""
+    
+    name = 'pyzbar'
+    
+    def _load(self):
+        from pyzbar import pyzbar
+        self._pyzbar = pyzbar
+        self._symbols = [pyzbar.ZBarSymbol.QRCODE]
+    
+    def _decode(self, image: np.ndarray) -> List[str]:
+        return [_decode_bytes(qr.data) for qr in self._pyzbar.decode(image, symbols=self._symbols)]
+
+class OpenCVBackend(DecoderBackend):
+    """cv2.QRCodeDetector reutilizado (uno por hilo)"""
+    
+    name = 'opencv'
+    
+    def _load(self):
+        cv2.QRCodeDetector()
+    
+    def _decode(self, image: np.ndarray) -> List[str]:
+        detector = self._thread_detector(cv2.QRCodeDetector)
+        retval, decoded_info, points, straight_qrcode = detector.detectAndDecodeMulti(image)
+        return list(decoded_info) if retval else []
+
+class OpenCVArucoBackend(OpenCVBackend):
+    """cv2.QRCodeDetectorAruco (OpenCV >= 4.8)"""
+    
+    name = 'opencv_aruco'
+    
+    def _load(self):
+        cv2.QRCodeDetectorAruco()
+    
+    def _decode(self, image: np.ndarray) -> List[str]:
+        detector = self._thread_detector(cv2.QRCodeDetectorAruco)
+        retval, decoded_info, points, straight_qrcode = detector.detectAndDecodeMulti(image)
+        return list(decoded_info) if retval else []
+
+class WeChatBackend(DecoderBackend):
+    """Detector WeChat de opencv-contrib (sin modelos CNN usa el detector clásico)"""
+    
+    name = 'wechat'
+    
+    def _load(self):
+        cv2.wechat_qrcode_WeChatQRCode()
+    
+    def _decode(self, image: np.ndarray) -> List[str]:
+        detector = self._thread_detector(cv2.wechat_qrcode_WeChatQRCode)
+        decoded_info, points = detector.detectAndDecode(image)
+        return list(decoded_info)
+
+class ZXingBackend(DecoderBackend):
+    """zxing-cpp (paquete zxing-cpp), si está instalado"""
+    
+    name = 'zxing'
+    
+    def _load(self):
+        import zxingcpp
+        self._zxingcpp = zxingcpp
+    
+    def _decode(self, image: np.ndarray) -> List[str]:
+        results = self._zxingcpp.read_barcodes(image, formats=self._zxingcpp.BarcodeFormat.QRCode)
+        return [result.text for result in results if result.valid]
+
+class DecoderRegistry:
+    """Registro de backends de decodificación disponibles por nombre"""
+    
+    def __init__(self):
+        self._backends: Dict[str, DecoderBackend] = {}
+    
+    def register(self, backend: DecoderBackend):
+        self._backends[backend.name] = backend
+    
+    def get(self, name: str) -> Optional[DecoderBackend]:
+        return self._backends.get(name)
+    
+    def names(self) -> List[str]:
+        return list(self._backends)
+    
+    def resolve(self, names: Sequence[str]) -> List[DecoderBackend]:
+        """
+        Obtiene los backends disponibles en el orden indicado
+        
+        Args:
+            names: Nombres de backend, o el nombre de un perfil de DECODER_PROFILES
+            
+        Returns:
+            Lista de backends instalados, en el mismo orden
+        """
+        backends = []
+        for name in names:
+            backend = self._backends.get(name)
+            if backend is None:
+                logger.warning(f"Decodificador desconocido: {name}")
+            elif backend.is_available():
+                backends.append(backend)
+        return backends
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Disponibilidad, latencia media y tasa de aciertos de cada backend"""
+        for backend in self._backends.values():
+            backend.is_available()
+        return {name: backend.stats() for name, backend in self._backends.items()}
+
+DECODER_REGISTRY = DecoderRegistry()
+for _backend_cls in (PyzbarBackend, OpenCVBackend, OpenCVArucoBackend, WeChatBackend, ZXingBackend):
+    DECODER_REGISTRY.register(_backend_cls())
+
+# Perfiles de decodificación: backends probados en orden sobre cada variante
+DECODER_PROFILES = {
+    'default': ['pyzbar'],
+    'fast': ['zxing', 'pyzbar'],
+    'robust': ['pyzbar', 'zxing', 'wechat', 'opencv_aruco'],
+    'opencv': ['opencv_aruco', 'opencv'],
+}
+
 class QRProcessor:
     """Procesador de códigos QR con múltiples algoritmos mejorados"""
     
-    def __init__(self):
+    # Modos de detección soportados
+    MODE_FIRST_HIT = 'first_hit'    # Detenerse en el primer código decodificado
+    MODE_EXHAUSTIVE = 'exhaustive'  # Ejecutar todos los métodos y reunir todos los códigos
+    DETECTION_MODES = (MODE_FIRST_HIT, MODE_EXHAUSTIVE)
+    
+    # Resolución gruesa: lado máximo del nivel de pirámide que se intenta primero
+    COARSE_MAX_SIDE = 1200
+    # Las ampliaciones de _detect_with_scaling no superan este lado
+    MAX_UPSCALED_SIDE = 2500
+    
+    # Localización de regiones candidatas
+    LOCATE_MAX_SIDE = 1200      # Lado máximo de la imagen usada para localizar
+    MAX_CANDIDATE_REGIONS = 4   # Regiones candidatas a decodificar por imagen
+    MIN_CROP_SIDE = 400         # Los recortes más pequeños se amplían hasta este lado
+    
+    # Inclinación mínima (grados) para intentar una pasada enderezada
+    MIN_SKEW_DEGREES = 2.0
+    
+    # Costo estimado de cada variante de preprocesamiento (ms por megapíxel)
+    PREPROCESSING_COST_MS = {
+        'original': 0.0,
+        'gaussian_blur_3': 1.0,
+        'gaussian_blur_5': 2.0,
+        'median_blur_3': 0.5,
+        'median_blur_5': 2.0,
+        'bilateral_9': 40.0,
+        'bilateral_15': 80.0,
+        'enhanced_contrast': 10.0,
+        'adaptive_threshold': 8.0,
+        'morphology_open': 0.6,
+        'morphology_close': 0.6,
+        'equalized': 1.2,
+        'inverted': 0.1,
+    }
+    # Una variante más cara que esto a resolución completa se filtra sobre un nivel reducido
+    MAX_VARIANT_COST_MS = 150.0
+    # Lado mínimo de ese nivel reducido (por debajo los módulos del QR se confunden)
+    MIN_FILTER_SIDE = 800
+    
+    def __init__(self, scheduler: Optional[MethodScheduler] = None, locate_regions: bool = True,
+                 coarse_to_fine: bool = True, parallel_workers: int = 0,
+                 hit_validator: Optional[Callable[[str], bool]] = None,
+                 decoders: Union[str, Sequence[str]] = 'default',
+                 registry: DecoderRegistry = DECODER_REGISTRY,
+                 duplicate_index=None,
+                 presence_check: bool = False):
+        """
+        Args:
+            scheduler: Planificador adaptativo de la cascada (opcional)
+            locate_regions: Localizar regiones QR candidatas y decodificar primero
+                            sobre recortes antes de procesar la imagen completa
+            coarse_to_fine: Intentar primero un nivel reducido de la pirámide y
+                            refinar a resolución completa solo alrededor de las
+                            regiones candidatas
+            parallel_workers: Hilos para evaluar variantes en paralelo (0 = secuencial)
+            hit_validator: Función que decide si un código cuenta como acierto
+                           para detener la búsqueda (None = cualquier código);
+                           los códigos válidos encabezan DetectionResult.codes
+            decoders: Perfil de DECODER_PROFILES o lista ordenada de backends
+                      que se prueban sobre cada variante
+            registry: Registro de backends de decodificación
+            duplicate_index: Índice de casi-duplicados (qr_cache.NearDuplicateIndex);
+                             si una imagen se parece a una ya decodificada, se
+                             decodifica primero solo la región QR recordada
+            presence_check: Si no se localiza ningún patrón de posición (tras el
+                            intento grueso), terminar sin ejecutar la cascada
+                            completa (estado 'no_candidate')
+        """
+        self.scheduler = scheduler
+        self.locate_regions = locate_regions
+        self.coarse_to_fine = coarse_to_fine
+        self.hit_validator = hit_validator
+        self.duplicate_index = duplicate_index
+        self.presence_check = presence_check
+        self.registry = registry
+        names = DECODER_PROFILES.get(decoders, [decoders]) if isinstance(decoders, str) else decoders
+        self.decoders = registry.resolve(names)
+        if not self.decoders:
+            logger.warning(f"Ningún decodificador disponible para {decoders}")
+        self._executor = None
+        if parallel_workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=parallel_workers,
+                                                thread_name_prefix='qr-variant')
+        self._local = threading.local()
         self.detection_methods = [
             self._detect_with_pyzbar,
             self._detect_with_opencv,
@@ -25,242 +786,533 @@ class QRProcessor:
             self._detect_with_regions
         ]
     
-    def detect_qr_codes(self, image: np.ndarray) -> List[str]:
+    def detect_qr_codes(self, image: Union[np.ndarray, ImageContext], mode: str = MODE_EXHAUSTIVE,
+                        max_attempts: Optional[int] = None,
+                        max_time_ms: Optional[float] = None,
+                        file_type: Optional[str] = None) -> List[str]:
         """
         Detecta códigos QR en una imagen usando múltiples métodos mejorados
         
+        Equivale a detect(...).codes; ver detect para los argumentos.
+        
+        Returns:
+            Lista de códigos QR detectados
+        """
+        return self.detect(image, mode, max_attempts, max_time_ms, file_type).codes
+    
+    def detect(self, image: Union[np.ndarray, ImageContext], mode: str = MODE_EXHAUSTIVE,
+               max_attempts: Optional[int] = None,
+               max_time_ms: Optional[float] = None,
+               file_type: Optional[str] = None,
+               presence_check: Optional[bool] = None) -> DetectionResult:
+        """
+        Detecta códigos QR en una imagen respetando el presupuesto indicado
+        
         Args:
-            image: Imagen como array de numpy
+            image: Imagen como array de numpy (o ImageContext ya construido)
+            mode: 'first_hit' para detenerse en el primer código decodificado,
+                  'exhaustive' para ejecutar todos los métodos
+            max_attempts: Máximo de intentos de decodificación para esta imagen
+            max_time_ms: Máximo de milisegundos para esta imagen
+            file_type: Tipo MIME de origen; con planificador activo se usa
+                       para ordenar la cascada según el historial de éxitos
+            presence_check: Pre-chequeo de patrones de posición para esta imagen
+                            (None = el configurado en el procesador)
             
         Returns:
-            Lista de códigos QR detectados
+            DetectionResult con los códigos y el estado ('found', 'not_found'
+            o 'budget_exhausted' si se agotaron intentos o tiempo)
         """
+        if mode not in self.DETECTION_MODES:
+            raise ValueError(f"Modo de detección no soportado: {mode}")
+        if presence_check is None:
+            presence_check = self.presence_check
+        
+        # Derivados de la imagen compartidos por todos los métodos
+        ctx = image if isinstance(image, ImageContext) else ImageContext(image)
+        
+        input_class = None
+        if self.scheduler is not None and file_type is not None:
+            input_class = MethodScheduler.classify(file_type, ctx.shape)
+        
+        budget = DetectionBudget(
+            first_hit=(mode == self.MODE_FIRST_HIT),
+            max_attempts=max_attempts,
+            max_time_ms=max_time_ms,
+            input_class=input_class,
+            hit_validator=self.hit_validator
+        )
+        
         qr_codes = []
-        found_codes = set()  # Para evitar duplicados
+        found_region = None
         
-        # Intentar con cada método
-        for method in self.detection_methods:
-            try:
-                detected = method(image)
-                if detected:
-                    for code in detected:
-                        if code and code not in found_codes:
-                            found_codes.add(code)
-                            qr_codes.append(code)
-                    # Si encontramos códigos con métodos básicos, continuar con métodos avanzados
-                    # para encontrar más códigos
-            except Exception as e:
-                logger.warning(f"Error en método de detección {method.__name__}: {e}")
-                continue
+        # Casi-duplicado de un documento ya visto: decodificar solo la región recordada
+        phash = None
+        duplicate = None
+        if self.duplicate_index is not None:
+            phash = ctx.perceptual_hash()
+            duplicate = self.duplicate_index.find(phash)
+            if duplicate is not None and duplicate.get('region'):
+                region_ctx = self._crop_context(ctx, duplicate['region'], arm_prefix='duplicate:')
+                self._run_cascade(region_ctx, budget, qr_codes)
+                if qr_codes:
+                    found_region = region_ctx.region
         
-        return qr_codes
-    
-    def _detect_with_pyzbar(self, image: np.ndarray) -> List[str]:
-        """Detección usando Pyzbar con múltiples variantes"""
-        from pyzbar import pyzbar
+        # Intento rápido sobre un nivel reducido de la pirámide (imágenes grandes)
+        if self.coarse_to_fine and max(ctx.shape) > self.COARSE_MAX_SIDE and not budget.should_stop():
+            self._detect_coarse(ctx, budget, qr_codes)
         
-        results = []
+        # Pre-chequeo barato: sin patrones de posición en la imagen reducida no hay QR
+        # que buscar (fotos sin factura, reversos en blanco) y se evita la cascada
+        no_candidate = (presence_check and not qr_codes and not budget.should_stop()
+                        and not self._candidate_regions(ctx))
         
-        # Probar con diferentes formatos
-        variants = []
+        # Refinar a resolución completa solo sobre recortes de las regiones candidatas
+        if self.locate_regions and not no_candidate and not budget.should_stop():
+            for region_ctx in self._region_contexts(ctx):
+                if budget.should_stop():
+                    break
+                found_before = len(qr_codes)
+                self._run_cascade(region_ctx, budget, qr_codes)
+                if found_region is None and len(qr_codes) > found_before:
+                    found_region = region_ctx.region
         
-        # 1. Escala de grises estándar
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            variants.append(('gray', gray))
-        else:
-            variants.append(('gray', image))
+        # Si los recortes no bastaron, procesar la imagen completa
+        if not no_candidate and not budget.should_stop():
+            self._run_cascade(ctx, budget, qr_codes)
         
-        # 2. RGB (para algunos casos)
-        if len(image.shape) == 3:
-            variants.append(('rgb', image))
+        # Los códigos que pasan la validación primero: el llamador toma codes[0]
+        if self.hit_validator is not None and len(qr_codes) > 1:
+            qr_codes.sort(key=lambda code: not self.hit_validator(code))
         
-        # 3. Invertido (para códigos QR blancos sobre fondo oscuro)
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        result = DetectionResult(qr_codes, budget)
+        if no_candidate and not qr_codes:
+            result.status = DetectionResult.STATUS_NO_CANDIDATE
+        if qr_codes and phash is not None:
+            result.region = found_region or self._first_region(ctx)
+            if duplicate is None or result.region != duplicate.get('region'):
+                self.duplicate_index.add(phash, {'region': result.region})
         else:
-            gray = image
-        inverted = cv2.bitwise_not(gray)
-        variants.append(('inverted', inverted))
+            result.region = found_region
+        if result.budget_exhausted:
+            logger.info(
+                f"Presupuesto de detección agotado: {budget.attempts} intentos, "
+                f"{budget.elapsed_ms:.0f} ms"
+            )
         
-        # Intentar decodificar con cada variante
-        for variant_name, variant_img in variants:
+        if input_class is not None:
+            self.scheduler.update(input_class, budget.outcomes)
+        
+        return result
+    
+    def _run_cascade(self, ctx: ImageContext, budget: DetectionBudget, qr_codes: List[str]):
+        """
+        Ejecuta los métodos de detección sobre una imagen hasta agotar el presupuesto
+        
+        Args:
+            ctx: Contexto de la imagen (página completa o recorte)
+            budget: Presupuesto de detección compartido
+            qr_codes: Lista de códigos encontrados (se amplía sin duplicados)
+        """
+        for method in self._order(budget, self.detection_methods,
+                                  lambda m: ctx.arm_prefix + m.__name__):
+            if budget.should_stop():
+                break
             try:
-                qr_codes = pyzbar.decode(variant_img)
-                for qr in qr_codes:
-                    try:
-                        decoded = qr.data.decode('utf-8')
-                        if decoded:
-                            results.append(decoded)
-                    except UnicodeDecodeError:
-                        # Intentar con diferentes codificaciones
-                        try:
-                            decoded = qr.data.decode('latin-1')
-                            if decoded:
-                                results.append(decoded)
-                        except:
-                            continue
+                method_start = time.perf_counter()
+                detected = method(ctx, budget)
+                budget.record(ctx.arm_prefix + method.__name__, bool(detected),
+                              (time.perf_counter() - method_start) * 1000)
+                for code in detected or []:
+                    if code and code not in qr_codes:
+                        qr_codes.append(code)
             except Exception as e:
-                logger.debug(f"Error en variante {variant_name}: {e}")
+                logger.warning(f"Error en método de detección {method.__name__}: {e}")
                 continue
+    
+    def _detect_coarse(self, ctx: ImageContext, budget: DetectionBudget, qr_codes: List[str]):
+        """
+        Decodificación rápida sobre el nivel de pirámide con lado mayor
+        <= COARSE_MAX_SIDE; la mayoría de los QR de factura se leen así con
+        una fracción de los píxeles
+        """
+        level = ctx.level_for_side(self.COARSE_MAX_SIDE)
+        coarse_ctx = ImageContext(ctx.pyramid_level(level), arm_prefix='coarse:')
         
-        return results
+        coarse_start = time.perf_counter()
+        detected = self._detect_with_pyzbar(coarse_ctx, budget)
+        budget.record('coarse:_detect_with_pyzbar', bool(detected),
+                      (time.perf_counter() - coarse_start) * 1000)
+        for code in detected:
+            if code and code not in qr_codes:
+                qr_codes.append(code)
+    
+    def _region_contexts(self, ctx: ImageContext) -> List[ImageContext]:
+        """
+        Construye contextos de recorte para las regiones QR candidatas
+        
+        Los recortes incluyen margen (zona de silencio) y se amplían si son
+        demasiado pequeños para decodificar de forma fiable.
+        """
+        return [self._crop_context(ctx, self._relative_region(ctx, region))
+                for region in self._candidate_regions(ctx)]
+        
+    def _candidate_regions(self, ctx: ImageContext) -> List[Tuple[int, int, int, int]]:
+        """Regiones de locate_qr_regions, calculadas una sola vez por imagen"""
+        if ctx.candidate_regions is None:
+            try:
+                ctx.candidate_regions = self.locate_qr_regions(ctx)
+            except Exception as e:
+                logger.warning(f"Error al localizar regiones QR: {e}")
+                ctx.candidate_regions = []
+        return ctx.candidate_regions
     
-    def _detect_with_opencv(self, image: np.ndarray) -> List[str]:
-        """Detección usando OpenCV QRCodeDetector"""
+    def _crop_context(self, ctx: ImageContext, region: Sequence[float],
+                      arm_prefix: str = 'crop:') -> ImageContext:
+        """
+        Contexto de recorte para un rectángulo relativo (x, y, ancho, alto)
+        
+        El recorte se amplía si su lado menor es inferior a MIN_CROP_SIDE.
+        """
+        h, w = ctx.shape
+        x0 = max(0, int(region[0] * w))
+        y0 = max(0, int(region[1] * h))
+        x1 = min(w, max(x0 + 1, int((region[0] + region[2]) * w)))
+        y1 = min(h, max(y0 + 1, int((region[1] + region[3]) * h)))
+        
+        crop = ctx.image[y0:y1, x0:x1]
+        short_side = min(x1 - x0, y1 - y0)
+        if short_side < self.MIN_CROP_SIDE:
+            factor = self.MIN_CROP_SIDE / short_side
+            crop = cv2.resize(crop, (int((x1 - x0) * factor), int((y1 - y0) * factor)),
+                              interpolation=cv2.INTER_CUBIC)
+        return ImageContext(crop, arm_prefix=arm_prefix, region=tuple(region))
+    
+    @staticmethod
+    def _relative_region(ctx: ImageContext, region: Tuple[int, int, int, int]) -> Tuple[float, float, float, float]:
+        """Convierte un rectángulo en píxeles a fracciones del tamaño de la imagen"""
+        h, w = ctx.shape
+        x, y, rw, rh = region
+        return (round(x / w, 4), round(y / h, 4), round(rw / w, 4), round(rh / h, 4))
+    
+    def _first_region(self, ctx: ImageContext) -> Optional[Tuple[float, float, float, float]]:
+        """Región candidata principal (para recordar dónde estaba un QR ya decodificado)"""
+        regions = self._candidate_regions(ctx)
+        return self._relative_region(ctx, regions[0]) if regions else None
+    
+    def locate_qr_regions(self, image: Union[np.ndarray, ImageContext]) -> List[Tuple[int, int, int, int]]:
+        """
+        Localiza regiones candidatas a contener un código QR
+        
+        Trabaja sobre un nivel reducido de la pirámide combinando
+        cv2.QRCodeDetector.detect con la búsqueda de patrones de posición
+        (finder patterns) por contornos anidados.
+        
+        Args:
+            image: Imagen como array de numpy (o ImageContext)
+            
+        Returns:
+            Lista de rectángulos (x, y, ancho, alto) en coordenadas de la
+            imagen original, con margen incluido
+        """
+        ctx = image if isinstance(image, ImageContext) else ImageContext(image)
+        h, w = ctx.shape
+        
+        # Elegir el primer nivel de pirámide cuyo lado mayor quepa en el límite
+        small = ctx.pyramid_level(ctx.level_for_side(self.LOCATE_MAX_SIDE))
+        scale_x = w / small.shape[1]
+        scale_y = h / small.shape[0]
+        
+        boxes = []
+        
+        # 1. Detector de OpenCV (solo localización, sin decodificar)
         try:
+            found, points = self._locator().detect(small)
+            if found and points is not None:
+                boxes.append(cv2.boundingRect(points.reshape(-1, 2).astype(np.float32)))
+        except cv2.error as e:
+            logger.debug(f"Error en localización OpenCV: {e}")
+        
+        # 2. Agrupaciones de patrones de posición
+        boxes.extend(self._finder_pattern_boxes(small))
+        
+        regions = []
+        for bx, by, bw, bh in self._merge_boxes(boxes)[:self.MAX_CANDIDATE_REGIONS]:
+            # Margen del 15% (mínimo 8 px) para conservar la zona de silencio
+            pad = max(8, int(0.15 * max(bw, bh)))
+            x0 = max(0, int((bx - pad) * scale_x))
+            y0 = max(0, int((by - pad) * scale_y))
+            x1 = min(w, int((bx + bw + pad) * scale_x))
+            y1 = min(h, int((by + bh + pad) * scale_y))
+            if x1 - x0 > 0 and y1 - y0 > 0:
+                regions.append((x0, y0, x1 - x0, y1 - y0))
+        
+        return regions
+    
+    def _locator(self) -> cv2.QRCodeDetector:
+        """Detector de OpenCV reutilizado por hilo"""
+        detector = getattr(self._local, 'locator', None)
+        if detector is None:
             detector = cv2.QRCodeDetector()
-            retval, decoded_info, points, straight_qrcode = detector.detectAndDecode(image)
+            self._local.locator = detector
+        return detector
+    
+    def _finder_pattern_boxes(self, gray: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        """
+        Busca patrones de posición (cuadrados anidados 1:1:3:1:1) y los agrupa
+        
+        Returns:
+            Rectángulos candidatos en coordenadas de la imagen recibida
+        """
+        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        contours, hierarchy = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        if hierarchy is None:
+            return []
+        hierarchy = hierarchy[0]
+        
+        finders = []
+        for i, contour in enumerate(contours):
+            # Un patrón de posición tiene al menos dos niveles de contornos hijos
+            depth, child = 0, hierarchy[i][2]
+            while child != -1 and depth < 2:
+                depth += 1
+                child = hierarchy[child][2]
+            if depth < 2:
+                continue
             
-            if retval and decoded_info:
-                return [info for info in decoded_info if info]
-        except Exception as e:
-            logger.warning(f"Error en detección OpenCV: {e}")
+            x, y, cw, ch = cv2.boundingRect(contour)
+            if cw < 7 or ch < 7 or not 0.7 < cw / ch < 1.4:
+                continue
+            if cv2.contourArea(contour) < 0.7 * cw * ch:
+                continue
+            finders.append((x, y, cw, ch))
         
-        return []
-    
-    def _detect_with_preprocessing(self, image: np.ndarray) -> List[str]:
-        """Detección con preprocesamiento avanzado de imagen"""
-        from pyzbar import pyzbar
+        # Agrupar patrones de tamaño similar y suficientemente cercanos
+        groups: List[List[Tuple[int, int, int, int]]] = []
+        for finder in finders:
+            fx, fy, fw, fh = finder
+            for group in groups:
+                gx, gy, gw, gh = group[0]
+                similar = 0.5 < fw / gw < 2
+                near = (abs(fx - gx) < 15 * gw) and (abs(fy - gy) < 15 * gh)
+                if similar and near:
+                    group.append(finder)
+                    break
+            else:
+                groups.append([finder])
         
-        results = []
+        boxes = []
+        # Los grupos con más patrones (idealmente 3) son los candidatos más fiables
+        for group in sorted(groups, key=len, reverse=True):
+            if len(group) < 2:
+                continue
+            x0 = min(f[0] for f in group)
+            y0 = min(f[1] for f in group)
+            x1 = max(f[0] + f[2] for f in group)
+            y1 = max(f[1] + f[3] for f in group)
+            bw, bh = x1 - x0, y1 - y0
+            # Con dos patrones la esquina faltante es ambigua: extender a un cuadrado
+            side = max(bw, bh)
+            x0, x1 = x0 - (side - bw), x1 + (side - bw)
+            y0, y1 = y0 - (side - bh), y1 + (side - bh)
+            boxes.append((x0, y0, x1 - x0, y1 - y0))
         
-        # Convertir a escala de grises base
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image.copy()
-        
-        # Aplicar diferentes preprocesamientos
-        preprocessed_images = [
-            ('original', gray),
-            ('gaussian_blur_3', cv2.GaussianBlur(gray, (3, 3), 0)),
-            ('gaussian_blur_5', cv2.GaussianBlur(gray, (5, 5), 0)),
-            ('median_blur_3', cv2.medianBlur(gray, 3)),
-            ('median_blur_5', cv2.medianBlur(gray, 5)),
-            ('bilateral_9', cv2.bilateralFilter(gray, 9, 75, 75)),
-            ('bilateral_15', cv2.bilateralFilter(gray, 15, 80, 80)),
-            ('enhanced_contrast', self._enhance_contrast(image)),
-            ('adaptive_threshold', self._adaptive_threshold(image)),
-            ('morphology_open', cv2.morphologyEx(gray, cv2.MORPH_OPEN, np.ones((3,3), np.uint8))),
-            ('morphology_close', cv2.morphologyEx(gray, cv2.MORPH_CLOSE, np.ones((3,3), np.uint8))),
-            ('equalized', cv2.equalizeHist(gray)),
-            ('inverted', cv2.bitwise_not(gray)),
-        ]
+        return boxes
+    
+    @staticmethod
+    def _merge_boxes(boxes: List[Tuple[int, int, int, int]]) -> List[Tuple[int, int, int, int]]:
+        """Une rectángulos solapados conservando el orden de prioridad"""
+        merged: List[Tuple[int, int, int, int]] = []
+        for box in boxes:
+            x, y, w, h = box
+            for i, (mx, my, mw, mh) in enumerate(merged):
+                if x < mx + mw and mx < x + w and y < my + mh and my < y + h:
+                    nx, ny = min(x, mx), min(y, my)
+                    merged[i] = (nx, ny, max(x + w, mx + mw) - nx, max(y + h, my + mh) - ny)
+                    break
+            else:
+                merged.append(box)
+        return merged
+    
+    def _order(self, budget: DetectionBudget, items: Sequence[Any],
+               name_fn: Callable[[Any], str]) -> List[Any]:
+        """Ordena métodos/variantes según el planificador, si está activo"""
+        if self.scheduler is None or budget.input_class is None:
+            return list(items)
+        return self.scheduler.order(budget.input_class, items, name_fn)
+    
+    def _decode(self, image: np.ndarray, budget: DetectionBudget, label: str) -> List[str]:
+        """
+        Decodifica una variante con los backends configurados, en orden
+        
+        Cada backend consume un intento del presupuesto; se detiene en el
+        primero que decodifica algo.
         
-        for method_name, processed_img in preprocessed_images:
+        Args:
+            image: Variante de la imagen a decodificar
+            budget: Presupuesto de detección de la imagen
+            label: Nombre de la variante (para logging)
+            
+        Returns:
+            Lista de códigos decodificados (vacía si no hay presupuesto)
+        """
+        results = []
+        for backend in self.decoders:
+            if not budget.try_attempt():
+                break
             try:
-                qr_codes = pyzbar.decode(processed_img)
-                for qr in qr_codes:
-                    try:
-                        decoded = qr.data.decode('utf-8')
-                        if decoded:
-                            results.append(decoded)
-                    except:
-                        continue
+                results = backend.decode(image)
             except Exception as e:
-                logger.debug(f"Error en preprocesamiento {method_name}: {e}")
+                logger.debug(f"Error en variante {label} ({backend.name}): {e}")
                 continue
+            if results:
+                break
         
+        if results:
+            budget.mark_found(results)
         return results
     
-    def _detect_with_rotation(self, image: np.ndarray) -> List[str]:
-        """Detección probando diferentes rotaciones"""
-        from pyzbar import pyzbar
+    def _detect_with_pyzbar(self, ctx: ImageContext, budget: DetectionBudget) -> List[str]:
+        """Detección usando Pyzbar con múltiples variantes"""
+        # Probar con diferentes formatos: gris estándar, color original
+        # (para algunos casos) e invertido (QR blancos sobre fondo oscuro)
+        variants = [('gray', lambda: ctx.gray)]
+        if ctx.is_color:
+            variants.append(('rgb', lambda: ctx.image))
+        variants.append(('inverted', lambda: ctx.inverted))
         
-        results = []
+        # Intentar decodificar con cada variante
+        return self._run_variants(ctx, budget, variants)
+    
+    def _detect_with_opencv(self, ctx: ImageContext, budget: DetectionBudget) -> List[str]:
+        """Detección usando OpenCV QRCodeDetector (reutilizado desde el registro)"""
+        backend = self.registry.get('opencv')
+        if backend is None or not backend.is_available() or not budget.try_attempt():
+            return []
+        try:
+            results = backend.decode(ctx.image)
+            if results:
+                budget.mark_found(results)
+            return results
+        except Exception as e:
+            logger.warning(f"Error en detección OpenCV: {e}")
         
-        # Convertir a escala de grises
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image.copy()
+        return []
+    
+    def _detect_with_preprocessing(self, ctx: ImageContext, budget: DetectionBudget) -> List[str]:
+        """
+        Detección con preprocesamiento avanzado de imagen
         
-        # Probar rotaciones: 90°, 180°, 270°
-        rotations = [90, 180, 270]
-        h, w = gray.shape
+        Cada variante se construye al intentarla. Su costo se estima por número
+        de píxeles (PREPROCESSING_COST_MS): las variantes se prueban de la más
+        barata a la más cara, las que superan MAX_VARIANT_COST_MS se filtran
+        sobre un nivel reducido de la pirámide y se omiten si ese nivel queda
+        por debajo de MIN_FILTER_SIDE o si no cabe en el tiempo restante.
+        """
+        # Cada preprocesamiento recibe el contexto del nivel en que se aplica
+        preprocessing = [
+            ('original', lambda c: c.gray),
+            ('gaussian_blur_3', lambda c: c.gaussian_blur(3)),
+            ('gaussian_blur_5', lambda c: c.gaussian_blur(5)),
+            ('median_blur_3', lambda c: c.median_blur(3)),
+            ('median_blur_5', lambda c: c.median_blur(5)),
+            ('bilateral_9', lambda c: cv2.bilateralFilter(c.gray, 9, 75, 75)),
+            ('bilateral_15', lambda c: cv2.bilateralFilter(c.gray, 15, 80, 80)),
+            ('enhanced_contrast', lambda c: c.clahe),
+            ('adaptive_threshold', lambda c: c.adaptive_threshold),
+            ('morphology_open', lambda c: cv2.morphologyEx(c.gray, cv2.MORPH_OPEN, np.ones((3,3), np.uint8))),
+            ('morphology_close', lambda c: cv2.morphologyEx(c.gray, cv2.MORPH_CLOSE, np.ones((3,3), np.uint8))),
+            ('equalized', lambda c: c.equalized),
+            ('inverted', lambda c: c.inverted),
+        ]
         
-        for angle in rotations:
-            try:
-                # Calcular matriz de rotación
-                center = (w // 2, h // 2)
-                matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
-                
-                # Rotar imagen
-                rotated = cv2.warpAffine(gray, matrix, (w, h), flags=cv2.INTER_LINEAR, 
-                                       borderMode=cv2.BORDER_REPLICATE)
-                
-                # Intentar detectar
-                qr_codes = pyzbar.decode(rotated)
-                for qr in qr_codes:
-                    try:
-                        decoded = qr.data.decode('utf-8')
-                        if decoded:
-                            results.append(decoded)
-                    except:
-                        continue
-            except Exception as e:
-                logger.debug(f"Error en rotación {angle}°: {e}")
+        h, w = ctx.shape
+        megapixels = h * w / 1e6
+        # Contextos de los niveles reducidos, creados al usarlos por primera vez
+        level_contexts: Dict[int, ImageContext] = {0: ctx}
+        
+        def at_level(level: int, apply: Callable[[ImageContext], np.ndarray]) -> Callable[[], np.ndarray]:
+            def build() -> np.ndarray:
+                if level not in level_contexts:
+                    level_contexts[level] = ImageContext(ctx.pyramid_level(level))
+                return apply(level_contexts[level])
+            return build
+        
+        variants = []
+        for name, apply in sorted(preprocessing, key=lambda item: self.PREPROCESSING_COST_MS[item[0]]):
+            cost_ms = self.PREPROCESSING_COST_MS[name] * megapixels
+            level = 0
+            while cost_ms > self.MAX_VARIANT_COST_MS:
+                level += 1
+                cost_ms /= 4
+            if level and max(h, w) / 2 ** level < self.MIN_FILTER_SIDE:
+                logger.debug(f"Variante {name} omitida: demasiado costosa para {w}x{h}")
+                continue
+            remaining_ms = budget.remaining_ms
+            if remaining_ms is not None and cost_ms > remaining_ms:
                 continue
+            variants.append((name, at_level(level, apply)))
         
-        return results
+        return self._run_variants(ctx, budget, variants, arm_group='preprocessing')
     
-    def _detect_with_scaling(self, image: np.ndarray) -> List[str]:
-        """Detección probando diferentes escalas"""
-        from pyzbar import pyzbar
+    def _detect_with_rotation(self, ctx: ImageContext, budget: DetectionBudget) -> List[str]:
+        """
+        Detección sobre la imagen enderezada según la inclinación estimada
         
-        results = []
+        Los giros de 90°/180°/270° no se prueban: los decodificadores leen el
+        QR en cualquier cuarto de vuelta (un giro así es solo una transposición
+        de la misma grilla de píxeles) y la orientación EXIF ya se aplica al
+        cargar. Solo una inclinación residual justifica una pasada más.
+        """
+        angle = ctx.skew_angle()
+        if abs(angle) < self.MIN_SKEW_DEGREES:
+            return []
         
-        # Convertir a escala de grises
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image.copy()
+        def deskew():
+            gray = ctx.gray
+            h, w = gray.shape
+            matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+            # Lienzo ampliado para no recortar las esquinas al rotar
+            cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+            new_w = int(h * sin + w * cos)
+            new_h = int(h * cos + w * sin)
+            matrix[0, 2] += new_w / 2 - w / 2
+            matrix[1, 2] += new_h / 2 - h / 2
+            return cv2.warpAffine(gray, matrix, (new_w, new_h), flags=cv2.INTER_LINEAR,
+                                  borderMode=cv2.BORDER_REPLICATE)
         
+        return self._run_variants(ctx, budget, [(f'enderezado {angle:.1f}°', deskew)])
+    
+    def _detect_with_scaling(self, ctx: ImageContext, budget: DetectionBudget) -> List[str]:
+        """Detección probando diferentes escalas"""
+        gray = ctx.gray
         h, w = gray.shape
         
         # Probar diferentes escalas (más pequeño y más grande)
-        scales = [0.5, 0.75, 1.25, 1.5, 2.0]
-        
-        for scale in scales:
-            try:
-                new_w = int(w * scale)
-                new_h = int(h * scale)
-                
-                # Evitar escalas demasiado pequeñas o grandes
-                if new_w < 50 or new_h < 50 or new_w > 5000 or new_h > 5000:
-                    continue
-                
-                # Redimensionar
-                scaled = cv2.resize(gray, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
-                
-                # Intentar detectar
-                qr_codes = pyzbar.decode(scaled)
-                for qr in qr_codes:
-                    try:
-                        decoded = qr.data.decode('utf-8')
-                        if decoded:
-                            results.append(decoded)
-                    except:
-                        continue
-            except Exception as e:
-                logger.debug(f"Error en escala {scale}: {e}")
+        scaled_images = []
+        for scale in [0.5, 0.75, 1.25, 1.5, 2.0]:
+            new_w = int(w * scale)
+            new_h = int(h * scale)
+            
+            # Evitar escalas demasiado pequeñas o grandes; ampliar una página
+            # de alta resolución completa no ayuda (los recortes ya se amplían)
+            if new_w < 50 or new_h < 50 or new_w > 5000 or new_h > 5000:
+                continue
+            if scale > 1 and max(new_w, new_h) > self.MAX_UPSCALED_SIDE:
                 continue
+            
+            # Redimensionar (la mitad se toma de la pirámide compartida)
+            if scale == 0.5:
+                build = lambda: ctx.pyramid_level(1)
+            else:
+                build = lambda size=(new_w, new_h): cv2.resize(gray, size, interpolation=cv2.INTER_CUBIC)
+            scaled_images.append((f'escala {scale}', build))
         
-        return results
+        return self._run_variants(ctx, budget, scaled_images)
     
-    def _detect_with_regions(self, image: np.ndarray) -> List[str]:
+    def _detect_with_regions(self, ctx: ImageContext, budget: DetectionBudget) -> List[str]:
         """Detección dividiendo la imagen en regiones (útil para imágenes grandes)"""
-        from pyzbar import pyzbar
-        
-        results = []
-        
-        # Convertir a escala de grises
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image.copy()
-        
+        gray = ctx.gray
         h, w = gray.shape
         
         # Solo dividir si la imagen es suficientemente grande
@@ -269,55 +1321,83 @@ class QRProcessor:
         
         # Dividir en 4 regiones (2x2)
         regions = [
-            gray[0:h//2, 0:w//2],           # Superior izquierda
-            gray[0:h//2, w//2:w],            # Superior derecha
-            gray[h//2:h, 0:w//2],            # Inferior izquierda
-            gray[h//2:h, w//2:w],            # Inferior derecha
+            ('región 0', lambda: gray[0:h//2, 0:w//2]),     # Superior izquierda
+            ('región 1', lambda: gray[0:h//2, w//2:w]),     # Superior derecha
+            ('región 2', lambda: gray[h//2:h, 0:w//2]),     # Inferior izquierda
+            ('región 3', lambda: gray[h//2:h, w//2:w]),     # Inferior derecha
         ]
         
-        for i, region in enumerate(regions):
+        return self._run_variants(ctx, budget, regions)
+    
+    def _run_variants(self, ctx: ImageContext, budget: DetectionBudget,
+                      variants: List[Tuple[str, Callable[[], np.ndarray]]],
+                      arm_group: Optional[str] = None) -> List[str]:
+        """
+        Construye y decodifica variantes de una imagen
+        
+        Con parallel_workers > 0 las variantes se reparten en el pool de hilos
+        (los filtros de OpenCV y el decodificador zbar liberan el GIL) y el
+        trabajo pendiente se cancela en cuanto una variante produce un acierto.
+        
+        Args:
+            ctx: Contexto de la imagen
+            budget: Presupuesto de detección compartido
+            variants: Lista de (nombre, función que construye la variante)
+            arm_group: Si se indica, las variantes se ordenan y registran en el
+                       planificador como '<arm_group>:<nombre>'
+            
+        Returns:
+            Lista de códigos decodificados
+        """
+        if arm_group is not None:
+            arm_name = lambda name: f"{ctx.arm_prefix}{arm_group}:{name}"
+            variants = self._order(budget, variants, lambda variant: arm_name(variant[0]))
+        else:
+            arm_name = None
+        
+        def try_variant(name, build) -> List[str]:
+            # Cancelación cooperativa de variantes que ya no hacen falta
+            if budget.should_stop():
+                return []
+            variant_start = time.perf_counter()
             try:
-                qr_codes = pyzbar.decode(region)
-                for qr in qr_codes:
-                    try:
-                        decoded = qr.data.decode('utf-8')
-                        if decoded:
-                            results.append(decoded)
-                    except:
-                        continue
+                decoded = self._decode(build(), budget, name)
             except Exception as e:
-                logger.debug(f"Error en región {i}: {e}")
-                continue
+                logger.debug(f"Error en variante {name}: {e}")
+                return []
+            if arm_name is not None:
+                budget.record(arm_name(name), bool(decoded),
+                              (time.perf_counter() - variant_start) * 1000)
+            return decoded
         
-        return results
-    
-    def _enhance_contrast(self, image: np.ndarray) -> np.ndarray:
-        """Mejora el contraste de la imagen"""
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image
+        results = []
+        if self._executor is None or len(variants) < 2:
+            for name, build in variants:
+                if budget.should_stop():
+                    break
+                results.extend(try_variant(name, build))
+            return results
         
-        # Aplicar CLAHE (Contrast Limited Adaptive Histogram Equalization)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        return clahe.apply(gray)
-    
-    def _adaptive_threshold(self, image: np.ndarray) -> np.ndarray:
-        """Aplica umbralización adaptativa"""
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image
+        futures = [self._executor.submit(try_variant, name, build) for name, build in variants]
+        try:
+            for future in as_completed(futures):
+                results.extend(future.result())
+                if budget.should_stop():
+                    break
+        finally:
+            # Las variantes que no empezaron se cancelan; las que están en curso
+            # terminan por su cuenta y su resultado se descarta
+            for future in futures:
+                future.cancel()
         
-        return cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2
-        )
+        return results
 
 class CUFEExtractor:
     """Extractor de claves CUFE de códigos QR"""
     
     def __init__(self):
         self.patterns = [
+            r'documentkey=([A-Za-z0-9]+)',
             r'CUFE[:\s]*([A-Za-z0-9+/=]+)',
             r'Clave[:\s]*([A-Za-z0-9+/=]+)',
             r'Código[:\s]*([A-Za-z0-9+/=]+)',
@@ -325,6 +1405,32 @@ class CUFEExtractor:
             r'Código\s+Único\s+de\s+Facturación\s+Electrónica[:\s]*([A-Za-z0-9+/=]+)',
             r'([A-Za-z0-9+/=]{40,})'  # Secuencia larga alfanumérica
         ]
+        # CUFE/CUDE de la DIAN: SHA-384 en hexadecimal (96 caracteres). Estos patrones
+        # son estrictos porque se aplican a texto arbitrario (capa de texto de un PDF)
+        self.document_key_patterns = [
+            r'documentkey=([0-9a-fA-F]{96})',
+            r'CU[FD]E[:\s]*((?:[0-9a-fA-F]\s*){96})',
+            r'(?<![0-9a-fA-F])([0-9a-fA-F]{96})(?![0-9a-fA-F])'
+        ]
+    
+    def find_document_key(self, text: str) -> Optional[str]:
+        """
+        Busca un CUFE/CUDE de la DIAN en texto libre o en una URL de consulta
+        
+        Args:
+            text: Texto de un documento o URI de un enlace
+            
+        Returns:
+            CUFE en minúsculas o None si no aparece
+        """
+        if not text:
+            return None
+        
+        for pattern in self.document_key_patterns:
+            match = re.search(pattern, text, re.IGNORECASE)
+            if match:
+                return re.sub(r'\s', '', match.group(1)).lower()
+        return None
     
     def extract_cufe(self, qr_data: str) -> Optional[str]:
         """